@@ -3,8 +3,11 @@ import numpy as np
 from PIL import Image
 import effect
 import output_image
+from pyrffect_global import premultiply, unpremultiply
+from pyrffect_trace import NULL_TRACER, NullTracer
 
 Master_ = Union["Pyrffect", None]
+Box_ = Tuple[int, int, int, int]  # x, y, fx, fy in the out_buffer
 
 
 class Calc:
@@ -16,6 +19,11 @@ class Calc:
     coords: Tuple[int, int]
     TIMESTEP: float = 0.033
     master: Master_
+    rng: np.random.Generator
+    box: Union[Box_, None]
+    premultiplied: bool
+    scale: float
+    tracer: NullTracer = NULL_TRACER
 
     @staticmethod
     def set_timestep(timestep):
@@ -24,21 +32,87 @@ class Calc:
     def __init__(self, coords=(0, 0), master: Master_ = None):
         self.buffer = None
         self.effects = []
+        # the coordinates and sizes are given at full scale, the calcs of a
+        # preview are scaled down as they are created
+        self.scale = 1.0 if master is None else master.scale
         self.coords = coords
+        if self.scale != 1.0:
+            self.coords = tuple(int(round(c * self.scale)) for c in coords)
         self.master = master
+        self.rng = np.random.default_rng()
+        self.box = None
+        self.premultiplied = False
 
     def set_dim(self, width: int, height: int):
         raise Exception("The dimension of a normal Calc are fixed")
 
+    def set_seed(self, seed: np.random.SeedSequence):
+        self.rng = np.random.default_rng(seed)
+        for e, effect_seed in zip(self.effects, seed.spawn(len(self.effects))):
+            e.set_seed(effect_seed)
+
+    def describe(self) -> str:
+        # name of the calc in the traces
+        return type(self).__name__
+
+    def set_premultiplied(self, premultiplied: bool):
+        # with premultiplied, the colors of out_buffer are multiplied by its alpha
+        # once the effects are applied
+        self.premultiplied = premultiplied
+
+    def content_box(self) -> Union[Box_, None]:
+        # part of out_buffer where the current frame is not transparent, None
+        # when it can be anywhere
+        box = self.box
+        for e in self.effects:
+            if box is None:
+                break
+            box = e.extend_box(box, self)
+        return box
+
+    def is_static(self) -> bool:
+        # a static calc displays the same out_buffer at every frame
+        return False
+
     def reset(self):
-        pass
+        for e in self.effects:
+            e.reset()
+
+    def get_state(self) -> dict:
+        # what the next frames depend on, the pixels left out as in skip
+        return {
+            "rng": self.rng.bit_generator.state,
+            "effects": [e.get_state() for e in self.effects],
+        }
+
+    def set_state(self, state: dict):
+        self.rng.bit_generator.state = state["rng"]
+        for e, effect_state in zip(self.effects, state["effects"]):
+            e.set_state(effect_state)
 
     def add_effect(self, effect: effect.Effect):
+        effect.set_scale(self.scale)
         self.effects.append(effect)
 
     def apply_effects(self):
+        premultiplied = self.premultiplied
+        pixels = self.out_buffer.shape[0] * self.out_buffer.shape[1]
         for e in self.effects:
-            e.apply(self)
+            if premultiplied and not e.premultiplied:
+                unpremultiply(self.out_buffer)
+                premultiplied = False
+            with self.tracer.span(type(e).__name__, "effect", pixels):
+                e.apply(self)
+        if self.premultiplied and not premultiplied:
+            premultiply(self.out_buffer)
+
+    def skip_effects(self):
+        for e in self.effects:
+            e.skip(self)
+
+    def skip(self):
+        # advance of one frame without rendering anything
+        self.skip_effects()
 
     def compute(self, output: Union[str, output_image.OutputImage]):
         self.apply_effects()
@@ -48,6 +122,10 @@ class Calc:
             output.paste_on(self)
 
     def save_as(self, name: str):
-        out = (self.out_buffer * np.array([1, 1, 1, 255])).astype(np.uint8)
+        out = self.out_buffer
+        if self.premultiplied:
+            out = np.copy(out)
+            unpremultiply(out)
+        out = (out * np.array([1, 1, 1, 255])).astype(np.uint8)
         img = Image.fromarray(out, mode="RGBA")
         img.save(name)
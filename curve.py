@@ -1,13 +1,28 @@
+import bisect
+import math
 import os
-from typing import List, Tuple, Union
+from typing import Callable, List, Tuple, Union
 import numpy as np
 import datetime
 
+Evaluator_ = Callable[[Union[float, np.ndarray]], Union[float, np.ndarray]]
+
 
 class Curve:
     def calc(self, t):
         raise NotImplementedError
 
+    def compile(self) -> Evaluator_:
+        # Function giving the values of the curve, which never modifies its input.
+        # Floats are computed without numpy. Curves without their own compile keep
+        # their calc, given a copy of the arrays.
+        def evaluate(t):
+            if isinstance(t, np.ndarray):
+                return self.calc(np.copy(t))
+            return self.calc(t)
+
+        return evaluate
+
 
 class LinearCurve(Curve):
     a: float  # coefficient directeur
@@ -20,6 +35,10 @@ class LinearCurve(Curve):
     def calc(self, t):
         return self.a * t + self.b
 
+    def compile(self) -> Evaluator_:
+        a, b = self.a, self.b
+        return lambda t: a * t + b
+
     def __str__(self) -> str:
         return f"P(x) = {self.a}*x + {self.b}"
 
@@ -50,6 +69,25 @@ class CappedCurve(Curve):
                 value[mask] = self.mini
         return value
 
+    def compile(self) -> Evaluator_:
+        child, mini, maxi = self.child_curve.compile(), self.mini, self.maxi
+
+        def evaluate(t):
+            value = child(t)
+            if not isinstance(value, np.ndarray):
+                if maxi is not None and value > maxi:
+                    value = maxi
+                if mini is not None and value < mini:
+                    value = mini
+                return value
+            if maxi is not None:
+                value = np.minimum(value, maxi)
+            if mini is not None:
+                value = np.maximum(value, mini)
+            return value
+
+        return evaluate
+
     def __str__(self) -> str:
         res = str(self.child_curve)
         if self.maxi is not None:
@@ -83,6 +121,24 @@ class CappedInCurve(Curve):
                 t[t < self.mini] = self.mini
             return self.child_curve.calc(t)
 
+    def compile(self) -> Evaluator_:
+        child, mini, maxi = self.child_curve.compile(), self.mini, self.maxi
+
+        def evaluate(t):
+            if not isinstance(t, np.ndarray):
+                if maxi is not None and t > maxi:
+                    t = maxi
+                if mini is not None and t < mini:
+                    t = mini
+                return child(t)
+            if maxi is not None:
+                t = np.minimum(t, maxi)
+            if mini is not None:
+                t = np.maximum(t, mini)
+            return child(t)
+
+        return evaluate
+
 
 class SinCurve(Curve):
     period: float
@@ -101,6 +157,16 @@ class SinCurve(Curve):
     def calc(self, t):
         return np.sin(t * self.period + self.phase) * self.ampl + self.dec
 
+    def compile(self) -> Evaluator_:
+        period, phase, ampl, dec = self.period, self.phase, self.ampl, self.dec
+
+        def evaluate(t):
+            if not isinstance(t, np.ndarray):
+                return math.sin(t * period + phase) * ampl + dec
+            return np.sin(t * period + phase) * ampl + dec
+
+        return evaluate
+
 
 class MulCurve(Curve):
     curve_a: Curve
@@ -113,6 +179,10 @@ class MulCurve(Curve):
     def calc(self, t):
         return self.curve_a.calc(t) * self.curve_b.calc(t)
 
+    def compile(self) -> Evaluator_:
+        curve_a, curve_b = self.curve_a.compile(), self.curve_b.compile()
+        return lambda t: curve_a(t) * curve_b(t)
+
 
 class ComposedCurve(Curve):
     caller: Curve
@@ -124,6 +194,10 @@ class ComposedCurve(Curve):
     def calc(self, t):
         return self.caller.calc(self.called.calc(t))
 
+    def compile(self) -> Evaluator_:
+        caller, called = self.caller.compile(), self.called.compile()
+        return lambda t: caller(called(t))
+
 
 class QuadraticCurve(Curve):
     a: float
@@ -138,6 +212,10 @@ class QuadraticCurve(Curve):
     def calc(self, t):
         return t * (self.a * t + self.b) + self.c
 
+    def compile(self) -> Evaluator_:
+        a, b, c = self.a, self.b, self.c
+        return lambda t: t * (a * t + b) + c
+
     def __str__(self) -> str:
         return f"P(x) = {self.a}*x^2 + {self.b}*x^+ {self.c}"
 
@@ -168,6 +246,25 @@ class PolynomCurve(Curve):
             result += c
         return result
 
+    def compile(self) -> Evaluator_:
+        coefficients = [float(c) for c in self.coefficients]
+
+        def evaluate(t):
+            if not isinstance(t, np.ndarray):
+                result = 0.0
+                for c in coefficients:
+                    result = result * t + c
+                return result
+            if len(coefficients) == 0:
+                return np.zeros(t.shape)
+            result = np.full(t.shape, coefficients[0])
+            for c in coefficients[1:]:
+                result *= t
+                result += c
+            return result
+
+        return evaluate
+
 
 class PolynomPointCurve(Curve):
     control_points: List[Tuple[float, float]]
@@ -204,6 +301,9 @@ class PolynomPointCurve(Curve):
     def calc(self, t):
         return self.true_curve.calc(t)
 
+    def compile(self) -> Evaluator_:
+        return self.true_curve.compile()
+
     def __str__(self):
         resA = ""
         resB = "["
@@ -292,6 +392,93 @@ class PolynomPointCurve(Curve):
         return L, Y
 
 
+class SplineCurve(Curve):
+    # Natural cubic spline through the control points ("x,y;x,y;..."), extended
+    # by straight lines beyond the first and the last points. The second
+    # derivatives are found by the Thomas algorithm, then each segment is a
+    # polynomial a + b*dx + c*dx^2 + d*dx^3 of dx = t - x of its first point.
+    control_points: List[Tuple[float, float]]
+    knots: np.ndarray
+    coefficients: np.ndarray  # a, b, c, d of each segment, extensions included
+    evaluator: Evaluator_
+
+    def __init__(self, control_points: Union[str, List[Tuple[float, float]]]):
+        if type(control_points) == str:
+            control_points = [
+                tuple([float(c) for c in p.split(",")])
+                for p in control_points.split(";")
+            ]
+        self.control_points = sorted(control_points)
+        if len(self.control_points) == 0:
+            raise Exception("A spline needs at least one control point")
+        x = np.array([p[0] for p in self.control_points], dtype=np.float64)
+        y = np.array([p[1] for p in self.control_points], dtype=np.float64)
+        h = np.diff(x)
+        if np.any(h <= 0):
+            raise Exception("Two control points of the spline share the same x")
+        n = len(x)
+        second = np.zeros(n)
+        if n > 2:
+            slopes = np.diff(y) / h
+            diagonal = 2 * (h[:-1] + h[1:])
+            rhs = 6 * np.diff(slopes)
+            # forward elimination then back substitution on the tridiagonal system
+            # h[i] * M[i] + diagonal[i] * M[i + 1] + h[i + 1] * M[i + 2] = rhs[i]
+            for i in range(1, n - 2):
+                w = h[i] / diagonal[i - 1]
+                diagonal[i] -= w * h[i]
+                rhs[i] -= w * rhs[i - 1]
+            second[n - 2] = rhs[-1] / diagonal[-1]
+            for i in range(n - 4, -1, -1):
+                second[i + 1] = (rhs[i] - h[i + 1] * second[i + 2]) / diagonal[i]
+        coefficients = np.zeros((n + 1, 4))
+        coefficients[0, 0] = y[0]
+        coefficients[-1, 0] = y[-1]
+        if n > 1:
+            a = y[:-1]
+            b = np.diff(y) / h - h * (2 * second[:-1] + second[1:]) / 6
+            c = second[:-1] / 2
+            d = np.diff(second) / (6 * h)
+            coefficients[1:-1] = np.stack((a, b, c, d), axis=-1)
+            coefficients[0, 1] = b[0]
+            coefficients[-1, 1] = b[-1] + 2 * c[-1] * h[-1] + 3 * d[-1] * h[-1] ** 2
+        self.knots = np.concatenate(([x[0]], x))
+        self.coefficients = coefficients
+        self.evaluator = self.compile()
+
+    def calc(self, t):
+        return self.evaluator(t)
+
+    def compile(self) -> Evaluator_:
+        knots, coefficients = self.knots, self.coefficients
+        # segment i + 1 starts at the point i, 0 and n being the extensions
+        bounds = list(knots[1:])
+        scalar_coefficients = [tuple(c) for c in coefficients]
+        scalar_knots = list(knots)
+
+        def evaluate(t):
+            if not isinstance(t, np.ndarray):
+                i = bisect.bisect_right(bounds, t)
+                a, b, c, d = scalar_coefficients[i]
+                dx = t - scalar_knots[i]
+                return a + dx * (b + dx * (c + dx * d))
+            i = np.searchsorted(knots[1:], t, side="right")
+            dx = t - knots[i]
+            segment = coefficients[i]
+            result = segment[..., 3] * dx
+            result += segment[..., 2]
+            result *= dx
+            result += segment[..., 1]
+            result *= dx
+            result += segment[..., 0]
+            return result
+
+        return evaluate
+
+    def __str__(self):
+        return ";".join(f"{x},{y}" for (x, y) in self.control_points)
+
+
 class SplitCurve(Curve):
     curve_a: Curve
     curve_b: Curve
@@ -316,6 +503,126 @@ class SplitCurve(Curve):
             value_A[mask] = value_B[mask]
             return value_A
 
+    def pieces(self, lower: float = -math.inf, upper: float = math.inf):
+        # the nested splits flattened as (upper bound, curve) on ]lower, upper]
+        result = []
+        for curve, lo, up in (
+            (self.curve_a, lower, min(upper, self.split_t)),
+            (self.curve_b, max(lower, self.split_t), upper),
+        ):
+            if up <= lo:
+                continue
+            if isinstance(curve, PolynomPointCurve):
+                curve = curve.true_curve
+            if isinstance(curve, SplitCurve):
+                result += curve.pieces(lo, up)
+            else:
+                result.append((up, curve))
+        return result
+
+    def compile(self) -> Evaluator_:
+        # each piece is only evaluated on the values of its own interval
+        pieces = self.pieces()
+        bounds = [up for (up, _) in pieces[:-1]]
+        evaluators = [curve.compile() for (_, curve) in pieces]
+        array_bounds = np.array(bounds)
+        if len(evaluators) == 1:
+            return evaluators[0]
+
+        def evaluate(t):
+            if not isinstance(t, np.ndarray):
+                return evaluators[bisect.bisect_left(bounds, t)](t)
+            # the values are grouped by piece with a stable sort of the piece
+            # indices, each piece then working on a contiguous slice
+            flat_t = t.reshape(-1)
+            index = np.searchsorted(array_bounds, flat_t).astype(np.uint16)
+            order = np.argsort(index, kind="stable")
+            counts = np.bincount(index, minlength=len(evaluators))
+            grouped = np.take(flat_t, order)
+            values = np.empty(grouped.shape)
+            start = 0
+            for evaluator, count in zip(evaluators, counts):
+                if count > 0:
+                    values[start : start + count] = evaluator(
+                        grouped[start : start + count]
+                    )
+                start += count
+            result = np.empty(flat_t.shape)
+            result[order] = values
+            return result.reshape(t.shape)
+
+        return evaluate
+
+
+class BakedCurve(Curve):
+    # Curve sampled once on [mini, maxi] and evaluated by linear interpolation
+    # between the samples, values outside of the interval being those of its
+    # bounds. The number of samples is doubled until the interpolation error,
+    # measured at the middle of each interval, is below max_error.
+    child_curve: Curve
+    mini: float
+    maxi: float
+    max_error: float
+    size: int
+    scale: float
+    values: np.ndarray
+    slopes: np.ndarray
+
+    MAX_SIZE: int = 1 << 20
+
+    def __init__(
+        self,
+        child_curve: Curve,
+        mini: float = 0.0,
+        maxi: float = 1.0,
+        max_error: float = 1e-4,
+    ) -> None:
+        self.child_curve = child_curve
+        self.mini = float(mini)
+        self.maxi = float(maxi)
+        self.max_error = max_error
+        size = 64
+        while True:
+            self.bake(size)
+            middles = self.mini + (np.arange(size) + 0.5) / self.scale
+            error = np.max(np.abs(self.calc(middles) - self.sample(middles)))
+            if error <= max_error or size >= self.MAX_SIZE:
+                break
+            size *= 2
+
+    def sample(self, t: np.ndarray) -> np.ndarray:
+        # child curves may return a scalar
+        values = self.child_curve.compile()(t)
+        return np.broadcast_to(np.asarray(values, dtype=np.float64), t.shape)
+
+    def bake(self, size: int):
+        self.size = size
+        self.scale = size / (self.maxi - self.mini)
+        self.values = np.array(self.sample(np.linspace(self.mini, self.maxi, size + 1)))
+        # the last slope is null so that maxi itself needs no special case
+        self.slopes = np.append(np.diff(self.values), 0)
+
+    def calc(self, t):
+        if not isinstance(t, np.ndarray):
+            u = min(max((t - self.mini) * self.scale, 0), self.size)
+            i = int(u)
+            return float(self.values[i] + self.slopes[i] * (u - i))
+        u = t - self.mini
+        u *= self.scale
+        np.clip(u, 0, self.size, out=u)
+        i = u.astype(np.intp)
+        u -= i
+        result = self.slopes[i]
+        result *= u
+        result += self.values[i]
+        return result
+
+    def compile(self) -> Evaluator_:
+        return self.calc
+
+    def __str__(self) -> str:
+        return f"baked({self.child_curve}, [{self.mini}, {self.maxi}], {self.size})"
+
 
 class BezierCurve(Curve):
     control_points: List[Tuple[float, float]]
@@ -509,7 +816,7 @@ if __name__ == "__main__":
             if len(self.points) > 1:
                 self.clean_curve()
                 print("________________________")
-                self.curve = PolynomPointCurve([(p.x, p.y) for p in self.points])
+                self.curve = SplineCurve([(p.x, p.y) for p in self.points])
 
                 xp, yp = 0, self.height - self.curve.calc(0)
                 for x in range(1, self.width):
@@ -3,5 +3,45 @@ import calc
 
 
 class Effect:
+    # whether apply can work on premultiplied colors, otherwise the calc converts
+    # its buffer to straight alpha before applying the effect
+    premultiplied: bool = False
+    # whether the calcs sharing the effect can apply it at the same time, the
+    # others apply it one after the other in the order of the layers
+    concurrent: bool = False
+
     def apply(self, other: "calc.Calc"):
         raise NotImplementedError
+
+    def skip(self, other: "calc.Calc"):
+        # update the internal state as apply would, without touching the pixels
+        pass
+
+    def extend_box(self, box: "calc.Box_", other: "calc.Calc") -> "calc.Box_":
+        # box of the content once the effect applied, from the box before it
+        return box
+
+    def set_seed(self, seed: np.random.SeedSequence):
+        pass
+
+    def reset(self):
+        pass
+
+    def get_state(self) -> dict:
+        # what the next frames depend on, the caches left out
+        return {}
+
+    def set_state(self, state: dict):
+        pass
+
+    def set_scale(self, scale: float):
+        # scale of the calcs using the effect, its sizes being given at full scale
+        pass
+
+    def set_canvas(self, width: int, height: int):
+        # called on the named effects, which can be shared by several calcs
+        pass
+
+    def new_frame(self):
+        # called on the named effects before every frame, rendered or skipped
+        pass
@@ -3,6 +3,7 @@ from typing import List, Tuple, Union
 from numpy.core.fromnumeric import shape
 from calc import Calc
 from curve import (
+    BakedCurve,
     ComposedCurve,
     Curve,
     LinearCurve,
@@ -13,10 +14,9 @@ from curve import (
     SinCurve,
 )
 import numpy as np
-import random
 import math
-from PIL import Image, ImageDraw
 from lighteffect import LightEffect
+from pyrffect_global import draw_doubled_ray, premultiply
 
 from output_image import OutputImage
 
@@ -29,8 +29,17 @@ class Firework(Calc):
     FW_LAUNCH = 1
     FW_BLOW = 2
     LAUNCH_TIME_PROP = 0.20
-    image_processed: Image.Image
-    image_drawer: ImageDraw.ImageDraw
+    STATE = (
+        "phase",
+        "time",
+        "duration",
+        "intensity",
+        "color",
+        "final_x",
+        "final_y",
+        "ref_dist",
+    )
+    clear_box: Tuple[int, int, int, int]
 
     width: int
     height: int
@@ -62,6 +71,7 @@ class Firework(Calc):
     size_amplifier: float
 
     colors: List[Tuple[int, int, int]]
+    random_colors: bool
     color: Tuple[int, int, int]
     rays: List[Angle]
 
@@ -90,16 +100,18 @@ class Firework(Calc):
         master=None,
     ) -> None:
         super().__init__(coords=coords, master=master)
-        self.image_processed = None
-        self.image_drawer = None
+        self.out_buffer = None
+        self.clear_box = None
         self.color = None
         self.width = None
         self.height = None
         self.ray_width = int(ray_width)
         self.size_amplifier = float(size_amplifier)
         self.lumiere = LightEffect(intensity=0)
+        # the light is placed on the scaled canvas by the firework itself
+        self.lumiere.set_scale(self.scale)
         if name_effect is not None and master is not None:
-            self.master.add_named_effect(name_effect, self.lumiere)
+            self.master.add_named_effect(name_effect, self.lumiere, self)
 
         self.min_x, self.max_x = map(int, x_stat.split(","))
         self.min_y, self.max_y, self.start_y = map(int, y_stat.split(","))
@@ -107,11 +119,9 @@ class Firework(Calc):
         self.min_intensity, self.max_intensity = map(float, intensity.split(","))
         self.min_pause, self.max_pause = map(float, pause.split(","))
 
-        if colors == "all":
-            self.colors = [(255, 0, 0), (0, 0, 255), (0, 255, 0)] + [
-                tuple(c) for c in np.random.randint(0, 255, size=(30, 3))
-            ]
-            self.colors = [(r, g, b, 255) for (r, g, b) in self.colors]
+        self.random_colors = colors == "all"
+        if self.random_colors:
+            self.draw_colors()
         else:
             colors = [tuple(map(int, c.split(","))) for c in colors.split(";")]
             self.colors = []
@@ -144,15 +154,26 @@ class Firework(Calc):
             dec=1 - 0.025 * flickering,
         )
         curve = MulCurve(xP4, ondulation)
-        self.intensity_curve = CappedCurve(curve, 0, 1)
+        self.intensity_curve = BakedCurve(CappedCurve(curve, 0, 1), mini=0, maxi=1)
 
         master.add_size_listener(self)
 
+    def draw_colors(self):
+        self.colors = [(255, 0, 0), (0, 0, 255), (0, 255, 0)] + [
+            tuple(c) for c in self.rng.integers(0, 255, size=(30, 3))
+        ]
+        self.colors = [(r, g, b, 255) for (r, g, b) in self.colors]
+
+    def set_seed(self, seed: np.random.SeedSequence):
+        super().set_seed(seed)
+        if self.random_colors:
+            self.draw_colors()
+
     def set_dim(self, width: int, height: int):
         self.width = width  # // 2
         self.height = height  # // 2
-        self.image_processed = Image.new("RGBA", (self.width * 2, self.height * 2))
-        self.image_drawer = ImageDraw.ImageDraw(self.image_processed, mode="RGBA")
+        self.out_buffer = np.zeros((self.height, self.width, 4), dtype=np.float32)
+        self.clear_box = None
         self.lumiere.set_dist(np.math.sqrt(self.width ** 2 + self.height ** 2))
 
     def enter_phase(self, phase: int):
@@ -170,7 +191,7 @@ class Firework(Calc):
 
         self.time = 0
         self.duration = (
-            random.random() * (self.max_pause - self.min_pause) + self.min_pause
+            self.rng.random() * (self.max_pause - self.min_pause) + self.min_pause
         )
         self.lumiere.set_intensity(0)
 
@@ -179,19 +200,19 @@ class Firework(Calc):
 
         self.time = 0
         self.duration = (
-            random.random() * (self.max_duration - self.max_duration)
+            self.rng.random() * (self.max_duration - self.max_duration)
             + self.min_duration
         )
         self.intensity = (
-            random.random() * (self.max_intensity - self.min_intensity)
+            self.rng.random() * (self.max_intensity - self.min_intensity)
             + self.min_intensity
         )
-        color = random.choice(self.colors)
+        color = self.colors[self.rng.integers(len(self.colors))]
         while color == self.color:
-            color = random.choice(self.colors)
+            color = self.colors[self.rng.integers(len(self.colors))]
         self.color = color
-        self.final_x = 2 * random.randint(self.min_x, self.max_x)
-        self.final_y = 2 * random.randint(self.min_y, self.max_y)
+        self.final_x = 2 * int(self.rng.integers(self.min_x, self.max_x + 1))
+        self.final_y = 2 * int(self.rng.integers(self.min_y, self.max_y + 1))
 
         self.lumiere.set_color(self.color)
         color_coeff_s = (self.intensity) / (self.max_intensity + self.min_intensity)
@@ -202,7 +223,9 @@ class Firework(Calc):
             s * color_coeff_s,
             v * color_coeff_v,
         )
-        self.lumiere.set_coords((self.final_x / 2, self.final_y / 2))
+        self.lumiere.set_coords(
+            (self.final_x / 2 * self.scale, self.final_y / 2 * self.scale)
+        )
 
         self.ref_dist = abs(self.final_y - self.start_y * 2)
         alpha = math.pi / 2
@@ -217,13 +240,13 @@ class Firework(Calc):
         nb_step = 6
         self.rays.clear()
         step = 2 * math.pi / nb_step
-        alpha = random.random() * 2 * math.pi
+        alpha = self.rng.random() * 2 * math.pi
         for i in range(nb_step):
             self.rays.append(alpha)
             alpha += step
 
     def compute(self, output: Union[str, OutputImage]):
-        if self.image_processed is None:
+        if self.out_buffer is None:
             raise Exception("Firework not ready to launch (size not given)")
         self.time += Calc.TIMESTEP
         if self.phase == self.FW_PAUSE:
@@ -235,20 +258,44 @@ class Firework(Calc):
         else:
             raise Exception("Trying to compute an unexpected phase")
 
+    def skip(self):
+        self.time += Calc.TIMESTEP
+        if self.phase == self.FW_PAUSE:
+            self.compute_pause()
+        elif self.phase == self.FW_LAUNCH:
+            if self.update_launch() is not None:
+                self.skip_effects()
+        elif self.phase == self.FW_BLOW:
+            if self.update_blow() is not None:
+                self.skip_effects()
+        else:
+            raise Exception("Trying to skip an unexpected phase")
+
     def compute_pause(self):
         if self.time > self.duration:
             self.enter_phase(self.FW_LAUNCH)
 
-    def compute_blow(self, output: Union[str, OutputImage]):
+    def update_blow(self):
+        # returns the progression of the explosion, or None when it just ended
         if self.time > self.duration * (1 - self.LAUNCH_TIME_PROP):
             self.enter_phase(self.FW_PAUSE)
-            return
-        self.image_processed.paste(
-            (0, 0, 0, 0), (0, 0, self.width * 2, self.height * 2)
-        )  # clear image
-
+            return None
         t = self.time / (self.duration * (1 - self.LAUNCH_TIME_PROP))
         self.lumiere.set_intensity(self.intensity_curve.calc(t) * self.intensity)
+        return t
+
+    def update_launch(self):
+        # returns the progression of the launch, or None when it just ended
+        if self.time > self.duration * self.LAUNCH_TIME_PROP:
+            self.enter_phase(self.FW_BLOW)
+            return None
+        return self.time / (self.duration * self.LAUNCH_TIME_PROP)
+
+    def compute_blow(self, output: Union[str, OutputImage]):
+        t = self.update_blow()
+        if t is None:
+            return
+        segments = []
         for ray in self.rays:
             d0 = self.blow_curve_d0.calc(t) * self.ref_dist
             d1 = self.blow_curve_d1.calc(t) * self.ref_dist
@@ -260,51 +307,86 @@ class Firework(Calc):
                 d1 * math.cos(ray) + self.final_x,
                 d1 * math.sin(ray) + self.final_y,
             )
-            self.image_drawer.line(
-                (x0, y0, x1, y1), fill=self.color, width=self.ray_width
-            )
-
-        self.out_buffer = np.array(
-            # self.image_processed
-            self.image_processed.resize(
-                (self.width, self.height), resample=Image.ANTIALIAS
-            ).convert("RGBA")
-        ).astype(np.float32)
-        self.apply_effects()
-        if type(output) == str:
-            self.save_as(output)
-        else:
-            self.out_buffer[:, :, 3] /= 255
-            output.paste_on(self)
+            segments.append((x0, y0, x1, y1))
+        self.draw(segments, output)
 
     def compute_launch(self, output: Union[str, OutputImage]):
-        if self.time > self.duration * self.LAUNCH_TIME_PROP:
-            self.enter_phase(self.FW_BLOW)
+        t = self.update_launch()
+        if t is None:
             return
-        self.image_processed.paste(
-            (0, 0, 0, 0), (0, 0, self.width * 2, self.height * 2)
-        )  # clear image
-
-        t = self.time / (self.duration * self.LAUNCH_TIME_PROP)
         ray = self.rays[0]
         d0 = self.launch_curve_d0.calc(t) * self.ref_dist
         d1 = self.launch_curve_d1.calc(t) * self.ref_dist
         x0, y0 = self.final_x, d0 * math.sin(ray) + self.final_y
         x1, y1 = self.final_x, d1 * math.sin(ray) + self.final_y
-        self.image_drawer.line((x0, y0, x1, y1), fill=self.color, width=self.ray_width)
-
-        self.out_buffer = np.array(
-            # self.image_processed
-            self.image_processed.resize(
-                (self.width, self.height), resample=Image.ANTIALIAS
-            ).convert("RGBA")
-        ).astype(np.float32)
+        self.draw([(x0, y0, x1, y1)], output)
+
+    def draw(
+        self,
+        segments: List[Tuple[float, float, float, float]],
+        output: Union[str, OutputImage],
+    ):
+        # the segments are given on the doubled image the rays were once drawn on
+        # and downsampled from, at full scale so that a preview draws the same
+        # fireworks
+        if self.clear_box is not None:
+            x, y, fx, fy = self.clear_box
+            self.out_buffer[y:fy, x:fx] = 0
+        self.box = None
+        for (x0, y0, x1, y1) in segments:
+            box = draw_doubled_ray(
+                self.out_buffer,
+                x0,
+                y0,
+                x1,
+                y1,
+                self.ray_width,
+                self.color,
+                self.scale,
+            )
+            if box is None:
+                continue
+            if self.box is None:
+                self.box = box
+            else:
+                self.box = (
+                    min(self.box[0], box[0]),
+                    min(self.box[1], box[1]),
+                    max(self.box[2], box[2]),
+                    max(self.box[3], box[3]),
+                )
+        if self.box is None:
+            self.box = (0, 0, 0, 0)
+        elif self.premultiplied:
+            x, y, fx, fy = self.box
+            premultiply(self.out_buffer[y:fy, x:fx])
         self.apply_effects()
+        self.clear_box = self.content_box()
         if type(output) == str:
             self.save_as(output)
         else:
-            self.out_buffer[:, :, 3] /= 255
             output.paste_on(self)
 
     def reset(self):
+        super().reset()
         self.enter_phase(self.FW_PAUSE)
+
+    def get_state(self) -> dict:
+        state = super().get_state()
+        for name in self.STATE:
+            state[name] = getattr(self, name, None)
+        state["rays"] = list(getattr(self, "rays", []))
+        state["lumiere"] = self.lumiere.get_state()
+        return state
+
+    def set_state(self, state: dict):
+        super().set_state(state)
+        for name in self.STATE:
+            setattr(self, name, state[name])
+        self.rays = list(state["rays"])
+        self.lumiere.set_state(state["lumiere"])
+        # the rays drawn before are not known anymore
+        if self.out_buffer is not None:
+            self.out_buffer.fill(0)
+        self.clear_box = None
+        self.box = None
@@ -27,22 +27,37 @@ class Flat(Calc):
                 self.color.append(1.0)
         self.width = width
         self.height = height
+        if width is not None and height is not None:
+            self.width = max(int(round(int(width) * self.scale)), 1)
+            self.height = max(int(round(int(height) * self.scale)), 1)
         self.listen_size = False
         if self.width is None or self.height is None:
             self.listen_size = True
             master.add_size_listener(self)
         else:
-            self.out_buffer = np.full(
-                (self.width, self.height, 4), self.color, dtype=np.float32
-            )
+            self.fill()
         self.buffer = None
 
+    def fill_color(self) -> ColorF_:
+        color = list(self.color)
+        if self.premultiplied:
+            color = [c * color[3] for c in color[:3]] + [color[3]]
+        return color
+
+    def fill(self):
+        self.out_buffer = np.full(
+            (self.height, self.width, 4), self.fill_color(), dtype=np.float32
+        )
+
     def set_dim(self, width, height, event=True):
         self.width = width
         self.height = height
-        self.out_buffer = np.full(
-            (self.width, self.height, 4), self.color, dtype=np.float32
-        )
+        self.fill()
+
+    def set_premultiplied(self, premultiplied: bool):
+        super().set_premultiplied(premultiplied)
+        if self.width is not None and self.height is not None:
+            self.fill()
 
     def stop_listen(self):
         if self.listen_size:
@@ -52,4 +67,10 @@ class Flat(Calc):
     def compute(self, output: Union[str, OutputImage]):
         if self.out_buffer is None:
             raise Exception("Flat surface was never given a size to be displayed")
+        if len(self.effects) > 0:
+            # the effects of a frame start again from the plain colour
+            self.out_buffer[:, :, :] = self.fill_color()
         super().compute(output)
+
+    def is_static(self) -> bool:
+        return len(self.effects) == 0
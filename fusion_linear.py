@@ -1,12 +1,46 @@
 from PIL import Image
+import numpy as np
 import fusion_mode
 
 FusionMode = fusion_mode.FusionMode
 
 
 class FusionLinear:
+    # fusing a transparent pixel leaves the image unchanged
+    transparent_neutral: bool = True
+    premultiplied: bool = False
+
+    @staticmethod
+    def fuse(imageA, imageB, out=None, scratch=None):
+        # out can be imageA, scratch is a pair of float32 arrays shaped as imageA
+        # and as its alpha channel (h, w, 1)
+        if out is None:
+            imageA = imageA * (1 - imageB[:, :, 3, None]) + imageB * imageB[:, :, 3, None]
+            imageA[:, :, 3] = 1.0
+            return imageA
+        if scratch is None:
+            scratch = (
+                np.empty(imageA.shape, np.float32),
+                np.empty(imageA.shape[:2] + (1,), np.float32),
+            )
+        colors, alpha = scratch
+        np.subtract(1, imageB[:, :, 3, None], out=alpha)
+        np.multiply(imageA, alpha, out=out)
+        np.multiply(imageB, imageB[:, :, 3, None], out=colors)
+        np.add(out, colors, out=out)
+        out[:, :, 3] = 1.0
+        return out
+
     @staticmethod
-    def fuse(imageA, imageB):
-        imageA = imageA * (1 - imageB[:, :, 3, None]) + imageB * imageB[:, :, 3, None]
-        imageA[:, :, 3] = 1.0
-        return imageA
+    def merge(imageA, imageB):
+        # layer equivalent to fusing imageA then imageB: fuse(fuse(C, A), B) and
+        # fuse(C, merge(A, B)) give the same colors
+        alphaA = imageA[:, :, 3, None]
+        alphaB = imageB[:, :, 3, None]
+        alpha = alphaB + alphaA * (1 - alphaB)
+        result = imageA * alphaA * (1 - alphaB) + imageB * alphaB
+        result = np.divide(
+            result, alpha, out=np.zeros_like(result), where=alpha > 0
+        )
+        result[:, :, 3] = alpha[:, :, 0]
+        return result
@@ -1,4 +1,11 @@
 class FusionMode:
+    transparent_neutral: bool = False
+    # whether the calcs give their buffers with premultiplied alpha
+    premultiplied: bool = False
+
     @staticmethod
-    def fuse(imageA, imageB):
-        return imageB
+    def fuse(imageA, imageB, out=None, scratch=None):
+        if out is None:
+            return imageB
+        out[:, :, :] = imageB
+        return out
@@ -0,0 +1,33 @@
+import numpy as np
+import fusion_mode
+
+FusionMode = fusion_mode.FusionMode
+
+
+class FusionPremultiplied:
+    # same result as FusionLinear, the calcs giving their colors already
+    # multiplied by their alpha
+    transparent_neutral: bool = True
+    premultiplied: bool = True
+
+    @staticmethod
+    def fuse(imageA, imageB, out=None, scratch=None):
+        # out can be imageA, scratch is a pair of float32 arrays shaped as imageA
+        # and as its alpha channel (h, w, 1)
+        if out is None:
+            imageA = imageA * (1 - imageB[:, :, 3, None]) + imageB
+            imageA[:, :, 3] = 1.0
+            return imageA
+        if scratch is None:
+            scratch = (None, np.empty(imageA.shape[:2] + (1,), np.float32))
+        _, alpha = scratch
+        np.subtract(1, imageB[:, :, 3, None], out=alpha)
+        np.multiply(imageA, alpha, out=out)
+        np.add(out, imageB, out=out)
+        out[:, :, 3] = 1.0
+        return out
+
+    @staticmethod
+    def merge(imageA, imageB):
+        # layer equivalent to fusing imageA then imageB, alpha included
+        return imageA * (1 - imageB[:, :, 3, None]) + imageB
@@ -1,27 +1,89 @@
+import os
 from typing import Coroutine, Tuple, Union
 
 from PIL import Image
 import numpy as np
 from calc import Calc
 from output_image import OutputImage
+from pyrffect_cache import ASSETS
+from pyrffect_global import premultiply, unpremultiply
 
 
 class ImageCalc(Calc):
-    def __init__(self, filename: str = None, coords=(0, 0), master=None):
+    filename: str
+
+    def __init__(
+        self,
+        filename: str = None,
+        coords=(0, 0),
+        master=None,
+        buffer: np.ndarray = None,
+    ):
+        # buffer is the image of filename when already decoded
         super().__init__(coords=coords, master=master)
+        self.filename = filename
         if filename is not None:
-            self.open(filename)
+            self.open(filename, buffer)
 
     def compute(self, output: Union[str, OutputImage]):
         if self.buffer is None:
             raise NotImplementedError
-        self.out_buffer[:, :, :] = self.buffer
+        if len(self.effects) > 0:
+            # without effect, out_buffer never leaves its copy of buffer
+            self.out_buffer[:, :, :] = self.buffer
         return super().compute(output)
 
-    def open(self, filename: str):
+    def set_premultiplied(self, premultiplied: bool):
+        # the image is converted once, out_buffer then restarts from it; buffer
+        # can be the read-only one of the asset cache, so it is replaced
+        if premultiplied != self.premultiplied and self.buffer is not None:
+            buffer = np.array(self.buffer)
+            if premultiplied:
+                premultiply(buffer)
+            else:
+                unpremultiply(buffer)
+            self.buffer = buffer
+            self.out_buffer[:, :, :] = self.buffer
+        super().set_premultiplied(premultiplied)
+
+    def crop(self, x: int, y: int, fx: int, fy: int):
+        # keeps the part [x, fx[ x [y, fy[ of the image, which stays in place
+        self.buffer = self.buffer[y:fy, x:fx]
+        self.out_buffer = np.array(self.buffer)
+        self.height, self.width, _ = self.buffer.shape
+        self.coords = (self.coords[0] + x, self.coords[1] + y)
+
+    def is_static(self) -> bool:
+        return len(self.effects) == 0
+
+    def describe(self) -> str:
+        return f"ImageCalc {os.path.basename(self.filename)}"
+
+    @staticmethod
+    def decode(filename: str, scale: float) -> np.ndarray:
         img = Image.open(filename)
         img = img.convert("RGBA")
-        self.buffer = np.array(img).astype(np.float32)
-        self.buffer[:, :, 3] /= 255.0
-        self.out_buffer = np.copy(self.buffer)
+        if scale != 1.0:
+            # downsampled once, the preview never needs the full image
+            size = tuple(max(int(round(s * scale)), 1) for s in img.size)
+            img = img.resize(size, Image.BOX)
+        buffer = np.array(img).astype(np.float32)
+        buffer[:, :, 3] /= 255.0
+        return buffer
+
+    @staticmethod
+    def load(filename: str, scale: float) -> np.ndarray:
+        # read-only, so that the calcs of a same file can share it
+        buffer = ASSETS.load(
+            filename, (scale,), lambda: ImageCalc.decode(filename, scale)
+        )
+        buffer.flags.writeable = False
+        return buffer
+
+    def open(self, filename: str, buffer: np.ndarray = None):
+        self.filename = filename
+        if buffer is None:
+            buffer = self.load(filename, self.scale)
+        self.buffer = buffer
+        self.out_buffer = np.array(self.buffer)
         self.height, self.width, _ = self.buffer.shape
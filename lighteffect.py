@@ -1,10 +1,13 @@
-from typing import Tuple
+from collections import OrderedDict
+import threading
+from typing import Dict, Tuple
 from effect import Effect
 from calc import Calc
-from curve import CappedCurve, CappedInCurve, Curve, PolynomCurve
+from curve import BakedCurve, CappedCurve, CappedInCurve, Curve, PolynomCurve
 import numpy as np
 
-from pyrffect_global import rgb_to_tsv, tsv_to_rgb
+from pyrffect_global import rgb_to_tsv, tsv_buffers, tsv_to_rgb
+from pyrffect_strips import STRIPS
 
 Color_ = Tuple[int, int, int]
 Coords_ = Tuple[float, float]
@@ -12,11 +15,26 @@ Coords_ = Tuple[float, float]
 
 class LightEffect(Effect):
     intensity: float
+    start_intensity: float
     coords: Coords_
     color: Color_
     intensity_curve: Curve
     dist_step: float
     color_tsv: Tuple[float, float, float]
+    distance_grids: "OrderedDict[Tuple[int, int, float, float], np.ndarray]"
+    GRID_CACHE_SIZE: int = 8
+    buffers: Dict[Tuple[int, int], tuple]
+    cutoff: float
+    CUTOFF_VALUE: float = 1e-3
+    canvas: Tuple[int, int]
+    field: np.ndarray
+    field_box: Tuple[int, int, int, int]
+    field_key: tuple
+    field_region: Tuple[int, int, int, int]
+    used: bool
+    scale: float
+    concurrent: bool = True
+    lock: threading.Lock
 
     def __init__(
         self,
@@ -34,6 +52,19 @@ class LightEffect(Effect):
             color = [float(e) for e in color.split(",")]
         self.color = tuple([color[0], color[1], color[2], 255])
         self.intensity = float(intensity)
+        self.start_intensity = self.intensity
+        self.distance_grids = OrderedDict()
+        self.buffers = {}
+        self.cutoff = None
+        self.canvas = None
+        self.field = None
+        self.field_box = None
+        self.field_key = None
+        self.field_region = None
+        self.used = False
+        self.scale = 1.0
+        # the caches are shared by the calcs applying the light concurrently
+        self.lock = threading.Lock()
         self.dist_step = float(dist_step)
         N = np.array([[self.color]])
         self.color_tsv = rgb_to_tsv(N)[:-1]
@@ -51,7 +82,9 @@ class LightEffect(Effect):
                 0.9990813317288378,
             ]
         )
-        self.intensity_curve = CappedInCurve(self.intensity_curve, maxi=1)
+        self.intensity_curve = BakedCurve(
+            CappedInCurve(self.intensity_curve, maxi=1), mini=0, maxi=1
+        )
 
     def set_color(self, color: Color_):
         self.color = color
@@ -68,36 +101,242 @@ class LightEffect(Effect):
     def set_dist(self, dist: float):
         self.dist_step = dist
 
-    def apply(self, other: Calc):
+    def set_scale(self, scale: float):
+        # a shared light can be given the scale by each of its calcs
+        ratio = scale / self.scale
+        if ratio == 1:
+            return
+        self.scale = scale
+        self.dist_step *= ratio
+        self.coords = (self.coords[0] * ratio, self.coords[1] * ratio)
+
+    def set_canvas(self, width: int, height: int):
+        # a shared light computes its intensity once per frame over the canvas,
+        # and only decays once per frame whatever the number of calcs using it
+        self.canvas = (width, height)
+        self.field = None
+        self.field_key = None
+        self.field_region = None
+
+    def new_frame(self):
+        if self.used and self.intensity >= 0.00001:
+            self.intensity -= 0.003
+        self.used = False
+
+    def reset(self):
+        self.intensity = self.start_intensity
+        self.used = False
+
+    def get_state(self) -> dict:
+        return {
+            "intensity": self.intensity,
+            "coords": self.coords,
+            "color": self.color,
+            "color_tsv": self.color_tsv,
+            "used": self.used,
+        }
+
+    def set_state(self, state: dict):
+        self.intensity = state["intensity"]
+        self.coords = state["coords"]
+        self.color = state["color"]
+        self.color_tsv = state["color_tsv"]
+        self.used = state["used"]
+
+    def decay(self):
+        if self.canvas is not None:
+            self.used = True
+        else:
+            self.intensity -= 0.003
+
+    def skip(self, other: Calc):
         if self.intensity < 0.00001:
             return
+        self.decay()
+
+    def distance_grid(self, other: Calc) -> np.ndarray:
+        # squared distance from the light to each pixel of other, only depending on
+        # their geometry: the grids of the last geometries met are kept
         vx, vy = other.coords
         vx -= self.coords[0]
         vy -= self.coords[1]
+        key = (other.width, other.height, vx, vy)
+        grid = self.distance_grids.get(key)
+        if grid is not None:
+            self.distance_grids.move_to_end(key)
+            return grid
+        dx = (vx + np.arange(other.width)) ** 2
+        dy = (vy + np.arange(other.height)) ** 2
+        grid = dx[None, :] + dy[:, None]
+        grid.flags.writeable = False
+        self.distance_grids[key] = grid
+        if len(self.distance_grids) > self.GRID_CACHE_SIZE:
+            self.distance_grids.popitem(last=False)
+        return grid
 
-        intensity_matrix = np.meshgrid(
-            vx + np.arange(other.width), vy + np.arange(other.height)
-        )  # why is it reversed...
-        intensity_matrix = intensity_matrix[0] ** 2 + intensity_matrix[1] ** 2
+    def tsv_buffers(self, shape: Tuple[int, int], size: Tuple[int, int]):
+        # the conversion buffers are kept for every layer shape the light met and
+        # every thread applying it, and their beginning is used for the smaller
+        # parts of the layer
+        key = (shape, threading.get_ident())
+        with self.lock:
+            if key not in self.buffers:
+                self.buffers[key] = tsv_buffers(shape)
+            out, scratch = self.buffers[key]
+        n = size[0] * size[1]
+        return (
+            tuple(b.reshape(-1)[:n].reshape(size) for b in out),
+            tuple(b.reshape(-1)[:n].reshape(size) for b in scratch),
+        )
+
+    def get_cutoff(self) -> float:
+        # curve parameter beyond which the light is below CUTOFF_VALUE, None when
+        # it can not be known
+        if self.cutoff is None and isinstance(self.intensity_curve, BakedCurve):
+            curve = self.intensity_curve
+            if abs(curve.values[-1]) > self.CUTOFF_VALUE:
+                return None
+            lit = np.nonzero(np.abs(curve.values) > self.CUTOFF_VALUE)[0]
+            self.cutoff = 0.0
+            if len(lit) > 0:
+                self.cutoff = curve.mini + (lit[-1] + 1) / curve.scale
+        return self.cutoff
 
-        intensity_matrix = self.intensity_curve.calc(
-            intensity_matrix / self.dist_step ** 2 / self.intensity ** 5
+    def lit_disc(self):
+        # box (x, y, fx, fy) of the canvas close enough to the light to be changed,
+        # None when it is unbounded
+        cutoff = self.get_cutoff()
+        if cutoff is None:
+            return None
+        radius = np.math.sqrt(cutoff) * self.dist_step * self.intensity ** 2.5
+        return (
+            int(np.math.floor(self.coords[0] - radius)),
+            int(np.math.floor(self.coords[1] - radius)),
+            int(np.math.ceil(self.coords[0] + radius)) + 1,
+            int(np.math.ceil(self.coords[1] + radius)) + 1,
         )
 
-        t, s, v, alpha = rgb_to_tsv(other.out_buffer)
-        tr, sr, vr = self.color_tsv
-        mask = v < 0.001
-        t[mask] = ((tr + 60 * t) % 360)[mask]
-        delta_t = tr - t
-        t += (
-            ((np.cos(2 * np.math.pi / 360 * delta_t) + 1.0) / 2.0) ** 2
-            * intensity_matrix
-            * delta_t
+    @staticmethod
+    def clip(box, x: int, y: int, width: int, height: int):
+        # box moved by (-x, -y) and clipped to [0, width[ x [0, height[
+        if box is None:
+            return 0, 0, width, height
+        return (
+            min(max(box[0] - x, 0), width),
+            min(max(box[1] - y, 0), height),
+            max(min(box[2] - x, width), 0),
+            max(min(box[3] - y, height), 0),
         )
-        self.intensity -= 0.003
 
-        s += sr * intensity_matrix ** 3
-        s[s > 1] = 1
-        v += vr * intensity_matrix ** 2
-        v[v > 1] = 1
-        other.out_buffer = tsv_to_rgb(t, s, v, alpha)
+    def lit_box(self, other: Calc):
+        # part (x, y, fx, fy) of the layer close enough to the light to be changed
+        height, width, _ = other.out_buffer.shape
+        ox, oy = other.coords
+        return self.clip(self.lit_disc(), int(ox), int(oy), width, height)
+
+    def add_field_region(self, other: Calc):
+        # the field only covers the part of the canvas where the calcs using the
+        # light were met
+        height, width, _ = other.out_buffer.shape
+        ox, oy = int(other.coords[0]), int(other.coords[1])
+        region = self.clip((ox, oy, ox + width, oy + height), 0, 0, *self.canvas)
+        if self.field_region is not None:
+            region = (
+                min(region[0], self.field_region[0]),
+                min(region[1], self.field_region[1]),
+                max(region[2], self.field_region[2]),
+                max(region[3], self.field_region[3]),
+            )
+        self.field_region = region
+
+    def canvas_field(self):
+        # intensity of the light over the lit part of the field region, computed
+        # once for all the calcs using the light at a frame
+        key = (self.coords, self.intensity, self.dist_step, self.field_region)
+        if key != self.field_key:
+            x, y, fx, fy = self.clip(self.lit_disc(), 0, 0, *self.canvas)
+            rx, ry, rfx, rfy = self.field_region
+            x, y = max(x, rx), max(y, ry)
+            fx, fy = max(min(fx, rfx), x), max(min(fy, rfy), y)
+            dx = ((x - self.coords[0]) + np.arange(max(fx - x, 0))) ** 2
+            dy = ((y - self.coords[1]) + np.arange(max(fy - y, 0))) ** 2
+            self.field = self.intensity_curve.calc(
+                (dx[None, :] + dy[:, None]) / self.dist_step ** 2 / self.intensity ** 5
+            ).astype(np.float32)
+            self.field.flags.writeable = False
+            self.field_box = (x, y, fx, fy)
+            self.field_key = key
+        return self.field, self.field_box
+
+    def intensity_field(self, other: Calc, box):
+        # intensity of the light over box of the layer, a view on the canvas field
+        # when the light is shared and box lies on the canvas
+        x, y, fx, fy = box
+        ox, oy = other.coords
+        if self.canvas is not None and ox == int(ox) and oy == int(oy):
+            x, y, fx, fy = x + int(ox), y + int(oy), fx + int(ox), fy + int(oy)
+            width, height = self.canvas
+            if 0 <= x and 0 <= y and fx <= width and fy <= height:
+                with self.lock:
+                    self.add_field_region(other)
+                    field, (cx, cy, _, _) = self.canvas_field()
+                return field[y - cy : fy - cy, x - cx : fx - cx]
+            x, y, fx, fy = box
+        with self.lock:
+            grid = self.distance_grid(other)[y:fy, x:fx]
+        return self.intensity_curve.calc(
+            grid / self.dist_step ** 2 / self.intensity ** 5
+        ).astype(np.float32)
+
+    def apply(self, other: Calc):
+        if self.intensity < 0.00001:
+            return
+        x, y, fx, fy = self.lit_box(other)
+        if fx <= x or fy <= y:
+            self.decay()
+            return
+        buffer = other.out_buffer[y:fy, x:fx]
+        intensity_matrix = self.intensity_field(other, (x, y, fx, fy))
+        out, scratch = self.tsv_buffers(other.out_buffer.shape[:2], buffer.shape[:2])
+
+        def strip(sy: int, sfy: int):
+            self.shade(
+                buffer[sy:sfy],
+                intensity_matrix[sy:sfy],
+                tuple(b[sy:sfy] for b in out),
+                tuple(b[sy:sfy] for b in scratch),
+            )
+
+        STRIPS.run(strip, fy - y)
+        self.decay()
+
+    def shade(self, buffer, intensity_matrix, out, scratch):
+        # light of the given intensities added to buffer, in place
+        t, s, v, alpha = rgb_to_tsv(buffer, out, scratch)
+        work, light, mask, _ = scratch
+        tr, sr, vr = self.color_tsv
+        np.less(v, 0.001, out=mask)
+        np.multiply(t, 60, out=work)
+        np.add(work, tr, out=work)
+        np.remainder(work, 360, out=work)
+        np.copyto(t, work, where=mask)
+        # delta_t in work, ((cos(delta_t) + 1) / 2) ** 2 * intensity in light
+        np.subtract(tr, t, out=work)
+        np.multiply(work, 2 * np.math.pi / 360, out=light)
+        np.cos(light, out=light)
+        np.add(light, 1.0, out=light)
+        np.multiply(light, 0.5, out=light)
+        np.square(light, out=light)
+        np.multiply(light, intensity_matrix, out=light)
+        np.multiply(light, work, out=light)
+        np.add(t, light, out=t)
+
+        np.square(intensity_matrix, out=light)
+        np.multiply(light, vr, out=work)
+        np.add(v, work, out=v)
+        np.minimum(v, 1, out=v)
+        np.multiply(light, intensity_matrix, out=light)
+        np.multiply(light, sr, out=light)
+        np.add(s, light, out=s)
+        np.minimum(s, 1, out=s)
+        tsv_to_rgb(t, s, v, alpha, buffer, scratch)
@@ -1,18 +1,69 @@
 import calc
 import fusion_linear
-from typing import Any, Tuple
+from pyrffect_trace import NULL_TRACER, NullTracer
+from pyrffect_strips import STRIPS
+from typing import Any, List, Tuple
+import os
+import queue
+import threading
 import numpy as np
 import subprocess as sp
+from PIL import Image
 
 FusionMode = fusion_linear.FusionMode
 FusionLinear = fusion_linear.FusionLinear
 
 FFMPEG = "ffmpeg"
+LOG_FILE = "log_file"
+
+
+def frame_checksums(filename: str) -> List[str]:
+    # md5 of every decoded frame of a video, as given by the framemd5 muxer
+    result = sp.run(
+        [FFMPEG, "-v", "error", "-i", filename, "-f", "framemd5", "-"],
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        check=True,
+    )
+    lines = result.stdout.decode().splitlines()
+    return [l.split(",")[-1].strip() for l in lines if l and not l.startswith("#")]
+
+
+def concat_segments(segments: List[str], out: str):
+    # the segments being encoded with the same settings, the concat demuxer joins
+    # their streams as they are, without encoding them again
+    listing = segments[0] + ".txt"
+    with open(listing, "w") as f:
+        for segment in segments:
+            path = os.path.abspath(segment).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+    try:
+        sp.run(
+            [FFMPEG, "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", listing]
+            + ["-c", "copy", out],
+            stdout=sp.DEVNULL,
+            stderr=sp.PIPE,
+            check=True,
+        )
+    finally:
+        os.remove(listing)
+
+
 class OutputImage:
     buffer: np.ndarray
+    scratch: Tuple[np.ndarray, np.ndarray]
+    staging: np.ndarray
+    background: np.ndarray
     fusion_mode: FusionMode
     width: int
     height: int
+    pipeline: int
+    frames: queue.Queue
+    free_frames: queue.Queue
+    writer: threading.Thread
+    writer_error: BaseException
+    writer_failed: bool
+    tracer: NullTracer
 
     def __init__(
         self,
@@ -21,6 +72,8 @@ class OutputImage:
         framerate: int,
         out_file: str,
         fusion_mode: FusionMode = None,
+        pipeline: int = 0,
+        preset: str = None,
     ) -> None:
         self.width = width
         self.height = height
@@ -29,7 +82,15 @@ class OutputImage:
         if fusion_mode is None:
             fusion_mode = FusionLinear()
         self.fusion_mode = fusion_mode
-        self.buffer = np.full((self.height, self.width, 4), 0)
+        # the canvas is blended in place, the scratch arrays and the uint8 frame
+        # are allocated once
+        self.buffer = np.zeros((self.height, self.width, 4), dtype=np.float32)
+        self.scratch = (
+            np.empty((self.height, self.width, 4), dtype=np.float32),
+            np.empty((self.height, self.width, 1), dtype=np.float32),
+        )
+        self.staging = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.background = None
 
         self.save_command = [
                 FFMPEG,
@@ -42,25 +103,61 @@ class OutputImage:
                 '-an',
                 '-crf', '10',
                 '-vcodec', 'libx264',
-                f'{self.out_file}'
             ]
+        if preset is not None:
+            # x264 speed against size, ultrafast for the previews
+            self.save_command += ['-preset', preset]
+        self.save_command.append(f'{self.out_file}')
         self.pipe = None
-        self.logfile = open("log_file", "w+")
+        self.logfile = None
+        # with pipeline > 0, the frames are written to ffmpeg by a thread while the
+        # next ones are rendered, at most pipeline frames waiting to be written
+        self.pipeline = pipeline
+        self.frames = None
+        self.free_frames = None
+        self.writer = None
+        self.writer_error = None
+        self.writer_failed = False
+        self.tracer = NULL_TRACER
 
     def paste_on(self, calc: 'calc.Calc'):
         buffer = calc.out_buffer
         h, w, _ = buffer.shape
         w, h = min(w, calc.width), min(h, calc.height)
+        bx, by = 0, 0
+        box = None
+        if self.fusion_mode.transparent_neutral:
+            box = calc.content_box()
+        if box is not None:
+            bx, by, bfx, bfy = box
+            w, h = min(w, bfx), min(h, bfy)
         x, y = calc.coords
         fx, fy = min(self.width, x + w), min(self.height, y + h)
-        w = fx - x
-        h = fy - y
-        self.buffer[y:fy, x:fx] = self.fusion_mode.fuse(
-            self.buffer[y:fy, x:fx], buffer[:h, :w]
-        )
+        x, y = x + bx, y + by
+        if fx <= x or fy <= y:
+            return
+        def strip(sy: int, sfy: int):
+            region = self.buffer[y + sy : y + sfy, x:fx]
+            self.fusion_mode.fuse(
+                region,
+                buffer[by + sy : by + sfy, bx : bx + fx - x],
+                out=region,
+                scratch=tuple(s[y + sy : y + sfy, x:fx] for s in self.scratch),
+            )
+
+        with self.tracer.span(calc.describe(), "paste_on", (fy - y) * (fx - x)):
+            STRIPS.run(strip, fy - y)
+
+    def set_background(self, background: np.ndarray):
+        # the buffer restarts from background instead of black at each frame
+        self.background = background
+        self.reset()
 
     def reset(self):
-        self.buffer.fill(0)
+        if self.background is None:
+            self.buffer.fill(0)
+        else:
+            self.buffer[:, :, :] = self.background
 
     def printProgressBar (self, iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r"):
         percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
@@ -71,15 +168,93 @@ class OutputImage:
         if iteration == total: 
             print()
 
+    def frame(self) -> np.ndarray:
+        # the returned array is overwritten by the next call
+        with self.tracer.span("uint8", "convert", self.width * self.height):
+            np.copyto(self.staging, self.buffer[:, :, :-1], casting="unsafe")
+        return self.staging
+
+    def save_as(self, name: str):
+        Image.fromarray(self.frame(), mode="RGB").save(name)
+
     def save(self, iter, total):
-        
-        
-        out = (self.buffer[:, :, :-1]).astype(np.uint8)
+        if self.pipeline <= 0:
+            self.write(self.frame(), iter, total)
+            return
+        self.start_writer()
+        # the frame buffers go back and forth between the writer and the renderer,
+        # so waiting for a free one bounds the advance of the renderer
+        frame = self.free_frames.get()
+        with self.tracer.span("uint8", "convert", self.width * self.height):
+            np.copyto(frame, self.buffer[:, :, :-1], casting="unsafe")
+        self.printProgressBar(iter, total)
+        self.queue_frame(frame, True)
+
+    def write(self, frame, iter, total):
+        self.printProgressBar(iter, total)
+        if self.pipeline <= 0:
+            self.write_pipe(frame)
+            return
+        self.start_writer()
+        self.queue_frame(frame, False)
+
+    def queue_frame(self, frame, pooled: bool):
+        # pooled frames are given back to free_frames once written; the index
+        # of the frame goes along, the renderer being on another one by then
+        if self.writer_error is not None:
+            error, self.writer_error = self.writer_error, None
+            raise error
+        self.frames.put((frame, pooled, self.tracer.frame))
+
+    def start_writer(self):
+        if self.writer is not None:
+            return
+        self.frames = queue.Queue(self.pipeline)
+        self.free_frames = queue.Queue()
+        for _ in range(self.pipeline + 1):
+            self.free_frames.put(np.empty((self.height, self.width, 3), dtype=np.uint8))
+        self.writer_error = None
+        self.writer_failed = False
+        self.writer = threading.Thread(target=self.write_frames, daemon=True)
+        self.writer.start()
+
+    def write_frames(self):
+        # body of the writer thread, None in the queue stops it
+        while True:
+            item = self.frames.get()
+            if item is None:
+                return
+            frame, pooled, index = item
+            if not self.writer_failed:
+                try:
+                    if isinstance(frame, np.ndarray):
+                        frame = memoryview(np.ascontiguousarray(frame).reshape(-1))
+                    self.write_pipe(frame, index)
+                except BaseException as err:
+                    # kept for the renderer, the next frames are only dropped
+                    self.writer_error = err
+                    self.writer_failed = True
+            if pooled:
+                self.free_frames.put(item[0])
+
+    def stop_writer(self):
+        if self.writer is None:
+            return
+        self.frames.put(None)
+        self.writer.join()
+        self.writer = None
+        self.frames = None
+        self.free_frames = None
+
+    def write_pipe(self, frame, index: int = None):
         if self.pipe is None:
+            self.logfile = open(LOG_FILE, "w+")
             self.pipe = sp.Popen(self.save_command, stdin=sp.PIPE, stderr=self.logfile)
-        self.printProgressBar(iter, total)
         try:
-            self.pipe.stdin.write(out.tostring())
+            with self.tracer.span(
+                "pipe write", "write", self.width * self.height, index
+            ):
+                self.pipe.stdin.write(frame)
         except IOError as err:
             ffmpeg_error = None
             if ffmpeg_error is not None:
@@ -135,8 +310,20 @@ class OutputImage:
             raise IOError(error)
         self.pipe.stdin.flush()
 
-    def close(self):
+    def close(self, raise_error: bool = True):
+        # without raise_error, an error of the writer is dropped, for a caller
+        # already stopping on an error of its own
+        self.stop_writer()
+        error, self.writer_error = self.writer_error, None
         if self.pipe is not None:
-            self.pipe.stdin.close()
+            try:
+                self.pipe.stdin.close()
+            except OSError as err:
+                # ffmpeg stopped before reading every frame
+                if error is None:
+                    error = err
             self.pipe.wait()
             self.pipe = None
+            self.logfile.close()
+        if error is not None and raise_error:
+            raise error
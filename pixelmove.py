@@ -1,6 +1,6 @@
 import numpy as np
+from typing import Dict, Tuple
 from calc import Calc
-from multiprocessing import Pool
 import effect
 
 Effect = effect.Effect
@@ -8,13 +8,21 @@ Effect = effect.Effect
 
 class PixelMove(Effect):
     square_size: int
+    full_square_size: int
     displace_probability: float
     area_covered: float
     ticks: int
     period: int
 
-    last_transform: list
-    implementation_clean: bool = True
+    last_transform: np.ndarray
+    transform_state: dict
+    transform_shape: Tuple[int, int]
+    premultiplied: bool = True
+    rng: np.random.Generator
+    moved_buffers: Dict[Tuple[int, int, int], np.ndarray]
+    remap: np.ndarray
+    remap_shape: Tuple[int, int, int]
+    BATCH_PIXELS: int = 1 << 20
 
     def __init__(
         self,
@@ -24,55 +32,156 @@ class PixelMove(Effect):
         ticks: int = 1,
     ) -> None:
         self.square_size = int(square_size)
+        self.full_square_size = self.square_size
         self.displace_probability = float(displace_probability)
         self.area_covered = float(area_covered)
         self.ticks = 0
         self.period = int(ticks)
         self.last_transform = None
+        self.transform_state = None
+        self.transform_shape = None
+        self.rng = np.random.default_rng()
+        self.moved_buffers = {}
+        self.remap = None
+        self.remap_shape = None
 
-    def move(self, other, x, y, fx, fy, nx, ny, nfx, nfy):
-        self.tmp_other.out_buffer[nx:nfx, ny:nfy] = other.out_buffer[x:fx, y:fy]
+    def set_seed(self, seed: np.random.SeedSequence):
+        self.rng = np.random.default_rng(seed)
+
+    def set_scale(self, scale: float):
+        self.square_size = max(int(round(self.full_square_size * scale)), 1)
+        self.last_transform = None
+        self.remap = None
+
+    def reset(self):
+        self.ticks = 0
+        self.last_transform = None
+        self.transform_state = None
+        self.remap = None
+
+    def get_state(self) -> dict:
+        # the transform is drawn again from the generator state it came from, which
+        # is lighter than its squares
+        return {
+            "ticks": self.ticks,
+            "rng": self.rng.bit_generator.state,
+            "transform_state": self.transform_state,
+            "transform_shape": self.transform_shape,
+        }
+
+    def set_state(self, state: dict):
+        self.ticks = state["ticks"]
+        self.last_transform = None
+        self.transform_state = None
+        self.remap = None
+        if state["transform_state"] is not None:
+            self.rng.bit_generator.state = state["transform_state"]
+            self.draw_transform(*state["transform_shape"])
+        self.rng.bit_generator.state = state["rng"]
+
+    def indices(self, transform: np.ndarray, shape):
+        # flat indices (destination, source) of the pixels moved by the squares of
+        # transform, in the order of the squares
+        x, y, fx, fy, nx, ny, nfx, nfy = (c[:, None, None] for c in transform.T)
+        offsets = np.arange(self.square_size)
+        di = offsets[None, :, None]
+        dj = offsets[None, None, :]
+        rows = np.minimum(fx - x, nfx - nx)
+        cols = np.minimum(fy - y, nfy - ny)
+        valid = (di < rows) & (dj < cols)
+        width = shape[1]
+        source = (x + di) * width + (y + dj)
+        destination = (nx + di) * width + (ny + dj)
+        return destination[valid], source[valid]
+
+    def batches(self, shape):
+        # (destination, source) indices of last_transform, by batches of squares
+        batch = max(self.BATCH_PIXELS // self.square_size ** 2, 1)
+        for start in range(0, len(self.last_transform), batch):
+            yield self.indices(self.last_transform[start : start + batch], shape)
+
+    def remap_table(self, shape):
+        # source of every pixel of the layer once last_transform applied, built
+        # once for all the frames of the period replaying it
+        if self.remap is None or self.remap_shape != shape:
+            self.remap = np.arange(shape[0] * shape[1])
+            for destination, source in self.batches(shape):
+                # numpy does not say which of repeated indices is written last,
+                # so only the last square reaching a pixel is kept
+                last = np.unique(destination[::-1], return_index=True)[1]
+                last = len(destination) - 1 - last
+                self.remap[destination[last]] = source[last]
+            self.remap_shape = shape
+        return self.remap
 
     def apply_last_transform(self, other: Calc):
-        if self.last_transform is None:
+        # every square is read from the buffer as it was before the moves, a
+        # pixel reached by several squares keeping the last one
+        if self.last_transform is None or len(self.last_transform) == 0:
             return
-        if self.implementation_clean:
-            self.apply_clean(other)
-        else:
-            self.apply_dirty(other)
-
-    def apply_dirty(self, other: Calc):
-        mp = Pool(len(self.last_transform))
-        self.tmp_other = other
-        mp.starmap(self.move, self.last_transform)
-        mp.close()
-
-    def apply_clean(self, other: Calc):
-        dim = self.last_transform.shape[0]
-        self.tmp_other = other
-        for i in range(dim):
-            x, y, fx, fy, nx, ny, nfx, nfy = self.last_transform[i]
-            self.move(other, x, y, fx, fy, nx, ny, nfx, nfy)
+        buffer = other.out_buffer
+        moved = self.moved_buffers.get(buffer.shape)
+        if moved is None:
+            moved = np.empty_like(buffer)
+            self.moved_buffers = {buffer.shape: moved}
+        np.take(
+            buffer.reshape(-1, buffer.shape[2]),
+            self.remap_table(buffer.shape),
+            axis=0,
+            out=moved.reshape(-1, buffer.shape[2]),
+            mode="clip",
+        )
+        np.copyto(buffer, moved)
 
     def apply(self, other: Calc):
+        self.update_transform(other)
+        return self.apply_last_transform(other)
+
+    def extend_box(self, box, other: Calc):
+        # the squares are all read before any is written, so the content can only
+        # be carried by the squares read from the box
+        if self.last_transform is None or len(self.last_transform) == 0:
+            return box
+        x, y, fx, fy, nx, ny, nfx, nfy = self.last_transform.T
+        left, top, right, bottom = box
+        moved = (fx > x) & (fy > y)
+        moved &= (x < bottom) & (fx > top) & (y < right) & (fy > left)
+        if not moved.any():
+            return box
+        return (
+            int(min(left, ny[moved].min())),
+            int(min(top, nx[moved].min())),
+            int(max(right, nfy[moved].max())),
+            int(max(bottom, nfx[moved].max())),
+        )
+
+    def skip(self, other: Calc):
+        self.update_transform(other)
+
+    def update_transform(self, other: Calc):
         self.ticks += 1
         if self.ticks < self.period:
-            return self.apply_last_transform(other)
+            return
         self.ticks = 0
         width, height, _ = other.out_buffer.shape
+        self.draw_transform(width, height)
+
+    def draw_transform(self, width: int, height: int):
+        self.transform_state = self.rng.bit_generator.state
+        self.transform_shape = (width, height)
         dimension = int(width * height // self.square_size * self.area_covered)
-        tirage = np.random.rand(dimension)
-        tirage = tirage[tirage < self.displace_probability]
-        dimension = tirage.shape[0]
+        # each of the dimension candidate squares moves with displace_probability
+        probability = min(max(self.displace_probability, 0), 1)
+        dimension = self.rng.binomial(dimension, probability)
         x, y = [
-            np.random.randint(0, width - 1, dimension),
-            np.random.randint(0, height - 1, dimension),
+            self.rng.integers(0, width - 1, dimension),
+            self.rng.integers(0, height - 1, dimension),
         ]
         fx = np.minimum(x + self.square_size, width)
         fy = np.minimum(y + self.square_size, height)
-        tirage = ((tirage * 1000) % 4).astype(np.int)
-        vx = np.choose(tirage, [1, -1, 0, 0])
-        vy = np.choose(tirage, [0, 0, 1, -1])
+        direction = self.rng.integers(0, 4, dimension)
+        vx = np.array([1, -1, 0, 0])[direction]
+        vy = np.array([0, 0, 1, -1])[direction]
         nx = x + vx
         ny = y + vy
         x[nx < 0] += 1
@@ -86,5 +195,4 @@ class PixelMove(Effect):
         fy[nfy - ny < fy - y] -= 1
 
         self.last_transform = np.stack((x, y, fx, fy, nx, ny, nfx, nfy), axis=-1)
-
-        return self.apply_last_transform(other)
+        self.remap = None
@@ -0,0 +1,426 @@
+import contextlib
+import getopt
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+import numpy as np
+from PIL import Image
+
+from curve import PolynomPointCurve, SplineCurve
+from firework import Firework
+from flat import Flat
+from fusion_linear import FusionLinear
+from lighteffect import LightEffect
+from output_image import OutputImage
+from pixelmove import PixelMove
+from pyrffect_global import rgb_to_tsv, tsv_buffers, tsv_to_rgb
+from pyrffect_parser import load_pyrffect
+from pyrffects import Pyrffect
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCENES = sorted(glob.glob(os.path.join(ROOT, "test", "*.xml"))) + [
+    os.path.join(ROOT, "final", "mabelae.xml")
+]
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+Result_ = Dict[str, float]
+
+
+def reference_rgb_to_tsv(buffer):
+    # former rgb_to_tsv, kept to check and measure the current one
+    alpha = buffer[:, :, 3]
+    maxi = np.max(buffer[:, :, :3], axis=-1)
+    mini = np.min(buffer[:, :, :3], axis=-1)
+
+    s = np.full(buffer.shape[:-1], 0, dtype=np.float32)
+
+    mask = maxi > 0.0001
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s[mask] = (1 - mini / maxi)[mask]
+    v = maxi / 255
+    delta = np.divide(
+        np.full(maxi.shape, 60, dtype=np.float32),
+        (maxi - mini),
+        out=np.full(maxi.shape, 0, dtype=np.float32),
+        where=np.abs(maxi - mini) > 0.25,
+    )
+
+    t = np.full(buffer.shape[:-1], 0, dtype=np.float32)
+    mask = np.isclose(maxi, buffer[:, :, 1])
+    t[mask] = ((buffer[:, :, 2] - buffer[:, :, 0]) * delta + 120)[mask]
+    mask = np.isclose(maxi, buffer[:, :, 2])
+    t[mask] = ((buffer[:, :, 0] - buffer[:, :, 1]) * delta + 240)[mask]
+    mask = np.isclose(maxi, buffer[:, :, 0])
+    t[mask] = (((buffer[:, :, 1] - buffer[:, :, 2]) * delta + 360) % 360)[mask]
+    return t, s, v, alpha
+
+
+def reference_tsv_to_rgb(t, s, v, alpha):
+    # former tsv_to_rgb, kept to check and measure the current one
+    t_i = (t / 60).astype(int) % 6
+    f = t / 60 - t_i
+    l = v * (1 - s)
+    m = v * (1 - f * s)
+    n = v * (1 - (1 - f) * s)
+    r = np.choose(t_i, [v, m, l, l, n, v]) * 255
+    g = np.choose(t_i, [n, v, v, m, l, l]) * 255
+    b = np.choose(t_i, [l, l, n, v, v, m]) * 255
+    return np.stack((r, g, b, alpha), axis=-1)
+
+
+def timeit(function, repeat: int) -> float:
+    # best time of repeat calls, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def random_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    # integer channels as in the decoded images, alpha in [0, 1]
+    rng = np.random.default_rng(seed)
+    buffer = rng.integers(0, 256, size=(height, width, 4)).astype(np.float32)
+    buffer[:, :, 3] /= 255
+    return buffer
+
+
+def bench_tsv(width: int = 1920, height: int = 1080, repeat: int = 10):
+    buffer = random_image(width, height)
+    out, scratch = tsv_buffers((height, width))
+    rgb = np.empty_like(buffer)
+
+    ref = reference_rgb_to_tsv(buffer)
+    new = rgb_to_tsv(buffer, out, scratch)
+    hue = np.abs(ref[0] - new[0])
+    hue = np.minimum(hue, 360 - hue)
+    errors = {
+        "t": float(hue.max()),
+        "s": float(np.abs(ref[1] - new[1]).max()),
+        "v": float(np.abs(ref[2] - new[2]).max()),
+        "rgb": float(
+            np.abs(
+                reference_tsv_to_rgb(*ref) - tsv_to_rgb(*ref, out=rgb, scratch=scratch)
+            ).max()
+        ),
+    }
+    if errors["t"] > 0.01 or errors["s"] > 1e-6 or errors["v"] > 1e-6:
+        raise Exception(f"rgb_to_tsv out of tolerance: {errors}")
+    if errors["rgb"] > 1e-3:
+        raise Exception(f"tsv_to_rgb out of tolerance: {errors}")
+
+    timings = {
+        "rgb_to_tsv reference": timeit(lambda: reference_rgb_to_tsv(buffer), repeat),
+        "rgb_to_tsv": timeit(lambda: rgb_to_tsv(buffer, out, scratch), repeat),
+        "tsv_to_rgb reference": timeit(lambda: reference_tsv_to_rgb(*ref), repeat),
+        "tsv_to_rgb": timeit(
+            lambda: tsv_to_rgb(*ref, out=rgb, scratch=scratch), repeat
+        ),
+    }
+    return timings, errors
+
+
+def result(seconds: float, amount: float, unit: str) -> Result_:
+    # throughput in unit per second, higher is better
+    return {"seconds": seconds, "throughput": amount / seconds, "unit": unit}
+
+
+def layer(width: int, height: int, seed: int = 0) -> Flat:
+    # calc of the given size holding a random image
+    calc = Flat(width, height)
+    calc.out_buffer[:, :, :] = random_image(width, height, seed)
+    return calc
+
+
+def bench_micro(width: int, height: int, repeat: int = 5) -> Dict[str, Result_]:
+    megapixels = width * height / 1e6
+    results = {}
+    buffer = random_image(width, height)
+    out, scratch = tsv_buffers((height, width))
+    results["rgb_to_tsv"] = result(
+        timeit(lambda: rgb_to_tsv(buffer, out, scratch), repeat), megapixels, "Mpx"
+    )
+
+    calc = layer(width, height)
+    light = LightEffect(
+        coords=(width / 2, height / 2), intensity=1, dist_step=max(width, height)
+    )
+
+    def light_apply():
+        light.set_intensity(1)
+        light.apply(calc)
+
+    results["LightEffect.apply"] = result(
+        timeit(light_apply, repeat), megapixels, "Mpx"
+    )
+
+    move = PixelMove(square_size=2, displace_probability=0.6, area_covered=0.6)
+    move.set_seed(np.random.SeedSequence(0))
+    results["PixelMove.apply"] = result(
+        timeit(lambda: move.apply(calc), repeat), megapixels, "Mpx"
+    )
+
+    canvas = random_image(width, height, 1)
+    fuse_scratch = (
+        np.empty((height, width, 4), dtype=np.float32),
+        np.empty((height, width, 1), dtype=np.float32),
+    )
+    results["FusionLinear.fuse"] = result(
+        timeit(
+            lambda: FusionLinear.fuse(canvas, buffer, out=canvas, scratch=fuse_scratch),
+            repeat,
+        ),
+        megapixels,
+        "Mpx",
+    )
+
+    frames = 90
+    results["Firework.compute"] = result(
+        timeit(lambda: firework_frames(width, height, frames), 1), frames, "frames"
+    )
+
+    t = np.random.default_rng(0).random(width * height)
+    baked = LightEffect().intensity_curve
+    results["curve baked"] = result(
+        timeit(lambda: baked.calc(t), repeat), megapixels, "Mpx"
+    )
+    rng = np.random.default_rng(0)
+    points = list(zip(np.linspace(0.05, 1, 40), rng.random(40)))
+    spline = SplineCurve(points).compile()
+    results["curve spline"] = result(
+        timeit(lambda: spline(t), repeat), megapixels, "Mpx"
+    )
+    split = PolynomPointCurve(points).compile()
+    results["curve split"] = result(
+        timeit(lambda: split(t), repeat), megapixels, "Mpx"
+    )
+    return results
+
+
+def firework_frames(width: int, height: int, frames: int):
+    master = Pyrffect("OUT", "img{}.png", width, height)
+    firework = Firework(
+        "all",
+        f"{width // 10},{width - width // 10}",
+        f"{height // 10},{height // 2},{height}",
+        "0.1,0.2",
+        "1,1.5",
+        "1,1.2",
+        name_effect="boum",
+        master=master,
+    )
+    firework.set_seed(np.random.SeedSequence(0))
+    firework.reset()
+    output = OutputImage(width, height, 0, None)
+    for _ in range(frames):
+        firework.compute(output)
+        output.reset()
+
+
+SYNTHETIC = """<?xml version="1.0" encoding="UTF-8"?>
+<Pyrffect width="{width}" height="{height}" seed="1">
+    <flat color="20,20,40"/>
+    <firework x_stat="{x0},{x1}" y_stat="{y0},{y1},{height}" duration="1,1.5"
+        intensity="1,1.2" pause="0.1,0.2" colors="all" name_effect="boum"
+        ray_width="10">
+        <pixel square_size="2" displace_probability="0.5" area_covered="0.5"/>
+    </firework>
+    <calc filename="layer.png" x="0" y="{half}">
+        <pixel square_size="3" displace_probability="0.6" ticks="3"/>
+        <named name="boum"/>
+    </calc>
+</Pyrffect>
+"""
+
+
+def synthetic_scene(directory: str, width: int, height: int) -> str:
+    # flat background, firework lighting an image layer, written in directory
+    image = random_image(width, height - height // 2, 2)
+    image[:, :, 3] = image[:, :, 3] > 0.3
+    image[:, :, 3] *= 255
+    Image.fromarray(image.astype(np.uint8), mode="RGBA").save(
+        os.path.join(directory, "layer.png")
+    )
+    filename = os.path.join(directory, f"synthetic_{width}x{height}.xml")
+    with open(filename, "w") as f:
+        f.write(
+            SYNTHETIC.format(
+                width=width,
+                height=height,
+                x0=width // 10,
+                x1=width - width // 10,
+                y0=height // 10,
+                y1=height // 2,
+                half=height // 2,
+            )
+        )
+    return filename
+
+
+@contextlib.contextmanager
+def working_directory(directory: str):
+    # the images of a scene are relative to its xml
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def bench_scene(filename: str, frames: int, encode: bool = False) -> Result_:
+    with working_directory(os.path.dirname(os.path.abspath(filename))):
+        p = load_pyrffect(os.path.basename(filename))
+    p.set_seed(1)
+    if encode:
+        # ffmpeg writes its log in the working directory
+        with tempfile.TemporaryDirectory() as directory:
+            with working_directory(directory):
+                start = time.perf_counter()
+                p.compute("bench.mp4", 30, frames)
+                seconds = time.perf_counter() - start
+        print()
+    else:
+        p.start()
+        output = OutputImage(p.width, p.height, 0, None, p.fusion_mode)
+        start = time.perf_counter()
+        for _ in range(frames):
+            p.render(output)
+            output.frame()
+            output.reset()
+        seconds = time.perf_counter() - start
+    return result(seconds, frames, "frames")
+
+
+def run(
+    suite: str,
+    resolutions: List[Tuple[int, int]],
+    frames: int,
+    encode: bool,
+) -> Dict[str, Result_]:
+    results = {}
+    if suite in ("all", "micro"):
+        for width, height in resolutions:
+            for name, r in bench_micro(width, height).items():
+                results[f"{name}@{width}x{height}"] = r
+    if suite in ("all", "scenes"):
+        with tempfile.TemporaryDirectory() as directory:
+            scenes = [synthetic_scene(directory, w, h) for (w, h) in resolutions]
+            for filename in scenes + SCENES:
+                name = "scene " + os.path.relpath(filename, directory)
+                if filename in SCENES:
+                    name = "scene " + os.path.relpath(filename, ROOT)
+                try:
+                    results[name] = bench_scene(filename, frames, encode)
+                except Exception as e:
+                    # a scene whose images are missing is reported, not measured
+                    print(f"{name} skipped: {e}", file=sys.stderr)
+    return results
+
+
+def compare(
+    results: Dict[str, Result_], baseline: Dict[str, Result_], threshold: float
+) -> List[str]:
+    # names of the benchmarks whose throughput dropped more than threshold
+    failures = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        ratio = r["throughput"] / baseline[name]["throughput"]
+        status = "ok"
+        if ratio < 1 - threshold:
+            status = "SLOWER"
+            failures.append(name)
+        print(f"{name:>40}: x{ratio:5.2f} {status}")
+    return failures
+
+
+def print_results(results: Dict[str, Result_]):
+    for name, r in results.items():
+        print(
+            f"{name:>40}: {r['seconds'] * 1000:10.2f} ms"
+            f" {r['throughput']:10.2f} {r['unit']}/s"
+        )
+
+
+USAGE = (
+    "python3 pyrffect_bench.py [-s --suite all|micro|scenes|tsv] "
+    "[-r --resolutions 640x360,1280x720] [-n --frames n] [-e --encode] "
+    "[-o --out results.json] [-c --compare baseline.json] [-t --threshold 0.1]"
+)
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "s:r:n:eo:c:t:",
+            [
+                "suite=",
+                "resolutions=",
+                "frames=",
+                "encode",
+                "out=",
+                "compare=",
+                "threshold=",
+            ],
+        )
+    except getopt.GetoptError as e:
+        print(e, USAGE, sep="\n", file=sys.stderr)
+        sys.exit(2)
+    suite, resolutions, frames, encode = "all", RESOLUTIONS, 30, False
+    out, baseline, threshold = None, None, 0.1
+    for o, a in opts:
+        if o in ("-s", "--suite"):
+            suite = a
+        elif o in ("-r", "--resolutions"):
+            resolutions = [tuple(map(int, r.split("x"))) for r in a.split(",")]
+        elif o in ("-n", "--frames"):
+            frames = int(a)
+        elif o in ("-e", "--encode"):
+            encode = True
+        elif o in ("-o", "--out"):
+            out = a
+        elif o in ("-c", "--compare"):
+            baseline = a
+        elif o in ("-t", "--threshold"):
+            threshold = float(a)
+
+    if suite == "tsv":
+        # conversions against their former versions
+        for width, height in resolutions:
+            timings, errors = bench_tsv(width, height)
+            print(f"HSV conversions on {width}x{height}, errors {errors}")
+            for name, duration in timings.items():
+                print(f"{name:>22}: {duration * 1000:8.2f} ms")
+            for name in ("rgb_to_tsv", "tsv_to_rgb"):
+                speedup = timings[name + " reference"] / timings[name]
+                print(f"{name} speedup: x{speedup:.2f}")
+        sys.exit(0)
+
+    results = run(suite, resolutions, frames, encode)
+    print_results(results)
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump(
+                {
+                    "frames": frames,
+                    "encode": encode,
+                    "numpy": np.__version__,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if baseline is not None:
+        with open(baseline) as f:
+            failures = compare(results, json.load(f)["results"], threshold)
+        if len(failures) > 0:
+            print(f"Throughput dropped by more than {threshold:.0%}: {failures}")
+            sys.exit(1)
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import threading
+from typing import Callable, Tuple
+import numpy as np
+
+Decoder_ = Callable[[], np.ndarray]
+
+CACHE_DIRECTORY = os.environ.get(
+    "PYRFFECT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "pyrffect")
+)
+CACHE_SIZE = 2 << 30  # bytes
+
+
+class AssetCache:
+    # Decoded assets kept on disk as .npy files, keyed on the path, mtime and
+    # size of their source file and on the parameters of their decoding. A hit
+    # maps the file read-only instead of decoding the source again. The least
+    # recently used files are removed once the cache is over max_size bytes.
+    directory: str
+    max_size: int
+
+    def __init__(self, directory: str = CACHE_DIRECTORY, max_size: int = CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def configure(self, directory: str, max_size: int = None):
+        # a None directory disables the cache
+        self.directory = directory
+        if max_size is not None:
+            self.max_size = max_size
+
+    def entry(self, filename: str, parameters: Tuple) -> str:
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, parameters)
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + ".npy")
+
+    def load(self, filename: str, parameters: Tuple, decode: Decoder_) -> np.ndarray:
+        # the returned array can be read-only
+        if self.directory is None:
+            return decode()
+        entry = self.entry(filename, parameters)
+        try:
+            buffer = np.load(entry, mmap_mode="r")
+            os.utime(entry)
+            return buffer
+        except (OSError, ValueError):
+            pass
+        buffer = decode()
+        try:
+            self.store(entry, buffer)
+        except OSError:
+            # the cache only saves time, a render never fails because of it
+            pass
+        return buffer
+
+    def store(self, entry: str, buffer: np.ndarray):
+        os.makedirs(self.directory, exist_ok=True)
+        # written aside then renamed, so that other renders never read half a file
+        temporary = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "wb") as f:
+                np.save(f, buffer)
+            os.replace(temporary, entry)
+        except BaseException:
+            # a full disk or an interruption leaves no partial file behind
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+        self.evict(entry)
+
+    def evict(self, keep: str):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                return
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+ASSETS = AssetCache()
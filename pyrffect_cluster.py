@@ -0,0 +1,332 @@
+import getopt
+import multiprocessing as mp
+import os
+import queue
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Dict, List, Tuple
+import xml.etree.ElementTree as Et
+import numpy as np
+
+from pyrffect_parser import load_pyrffect
+import output_image
+from output_image import concat_segments, frame_checksums
+
+Address_ = Tuple[str, int]
+Segment_ = Tuple[str, List[str]]  # file, checksums of its frames
+
+CHUNK = 300
+HEARTBEAT = 5  # seconds between the signs of life of a worker
+TIMEOUT = 60  # seconds the coordinator waits without any worker
+
+
+def parse_address(address: str) -> Address_:
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def work(address: Address_, authkey: bytes):
+    # Render the chunks given by the coordinator until it says stop. The scene
+    # file is read from the path the coordinator knows it by, so a worker on
+    # another host runs from a copy of the same directory.
+    scene = (None, None, None)
+    lock = threading.Lock()
+    stopped = threading.Event()
+    with tempfile.TemporaryDirectory() as directory, Client(
+        address, authkey=authkey
+    ) as conn:
+
+        def send(message):
+            with lock:
+                conn.send(message)
+
+        def beat():
+            # the coordinator takes a silent worker for a dead one
+            while not stopped.wait(HEARTBEAT):
+                try:
+                    send(("alive",))
+                except OSError:
+                    return
+
+        # the ffmpeg logs of the local workers would overwrite each other
+        output_image.LOG_FILE = os.path.join(directory, "log_file")
+        threading.Thread(target=beat, daemon=True).start()
+        try:
+            while True:
+                try:
+                    job = conn.recv()
+                except EOFError:
+                    # the coordinator stopped after an error
+                    return
+                if job[0] == "stop":
+                    return
+                _, filename, seed, framerate, start, end = job
+                segment = os.path.join(directory, f"segment{start}.mp4")
+                try:
+                    if scene[:2] != (filename, seed):
+                        # the scene is kept, so that the next chunk only simulates
+                        # the frames between the two chunks
+                        p = load_pyrffect(filename)
+                        p.set_seed(seed)
+                        scene = (filename, seed, p)
+                    scene[2].compute(segment, framerate, end, start)
+                    checksums = frame_checksums(segment)
+                    with open(segment, "rb") as f:
+                        data = f.read()
+                    os.remove(segment)
+                except Exception as e:
+                    send(("error", start, f"{type(e).__name__}: {e}"))
+                    continue
+                send(("segment", start, data, checksums))
+        finally:
+            stopped.set()
+
+
+def receive(conn: Connection):
+    # the answer of a worker to its chunk, EOFError when it stays silent longer
+    # than a few heartbeats
+    while True:
+        if not conn.poll(4 * HEARTBEAT):
+            raise EOFError("The worker stopped answering")
+        answer = conn.recv()
+        if answer[0] != "alive":
+            return answer
+
+
+def coordinate(
+    filename: str,
+    seed: int,
+    out: str,
+    framerate: int,
+    frame: int,
+    address: Address_,
+    authkey: bytes,
+    chunk: int = CHUNK,
+    workers: int = 0,
+    start: int = 0,
+    timeout: float = TIMEOUT,
+):
+    # Split the frames [start, frame) in chunks rendered to segments by the
+    # workers connecting to address, `workers` of them started here, then join
+    # the segments into out. A worker lost during a chunk gives it back to the
+    # others, and the render fails once no worker is left for timeout seconds.
+    # The frames of out are checked against the ones of the segments.
+    chunks = queue.Queue()
+    for s in range(start, frame, chunk):
+        chunks.put((s, min(s + chunk, frame)))
+    total = chunks.qsize()
+    segments: Dict[int, Segment_] = {}
+    errors = []
+    lock = threading.Lock()
+    done = threading.Event()
+    alive = {"workers": 0, "since": time.monotonic()}
+    if total == 0:
+        raise Exception("No frame to render")
+    # kept next to out like the renders of pyrffect_parser.py do
+    with open(out + ".seed", "w") as f:
+        f.write(f"{seed}\n")
+
+    with tempfile.TemporaryDirectory() as directory, Listener(
+        address, authkey=authkey
+    ) as listener:
+
+        def serve(conn: Connection):
+            with lock:
+                alive["workers"] += 1
+            try:
+                with conn:
+                    serve_chunks(conn)
+            finally:
+                with lock:
+                    alive["workers"] -= 1
+                    alive["since"] = time.monotonic()
+
+        def serve_chunks(conn: Connection):
+            while not done.is_set():
+                try:
+                    s, e = chunks.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                try:
+                    conn.send(("render", filename, seed, framerate, s, e))
+                    answer = receive(conn)
+                except (EOFError, OSError):
+                    # given back to the workers left
+                    chunks.put((s, e))
+                    return
+                if answer[0] == "error":
+                    errors.append(f"Frames {s} to {e}: {answer[2]}")
+                    done.set()
+                    return
+                _, _, data, checksums = answer
+                if len(checksums) != e - s:
+                    errors.append(
+                        f"Frames {s} to {e}: {len(checksums)} frames in the segment"
+                    )
+                    done.set()
+                    return
+                segment = os.path.join(directory, f"segment{s:09d}.mp4")
+                with open(segment, "wb") as f:
+                    f.write(data)
+                with lock:
+                    segments[s] = (segment, checksums)
+                    print(f"Segment {len(segments)}/{total}: frames {s} to {e}")
+                    if len(segments) == total:
+                        done.set()
+            try:
+                conn.send(("stop",))
+            except OSError:
+                pass
+
+        def accept():
+            while not done.is_set():
+                try:
+                    conn = listener.accept()
+                except mp.AuthenticationError:
+                    continue
+                except OSError:
+                    return
+                threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+        print(f"Waiting for workers on {listener.address[0]}:{listener.address[1]}")
+        threading.Thread(target=accept, daemon=True).start()
+        processes = [
+            mp.Process(target=work, args=(listener.address, authkey))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        while not done.wait(1):
+            with lock:
+                idle = alive["workers"] == 0
+                silent = time.monotonic() - alive["since"]
+                left = total - len(segments)
+            if idle and len(processes) > 0 and not any(p.is_alive() for p in processes):
+                errors.append(f"No worker left, {left} chunks not rendered")
+            elif idle and silent > timeout:
+                errors.append(f"No worker for {timeout} s, {left} chunks not rendered")
+            else:
+                continue
+            done.set()
+        if len(errors) > 0:
+            for process in processes:
+                process.terminate()
+        for process in processes:
+            process.join()
+        if len(errors) > 0:
+            raise Exception(errors[0])
+
+        ordered = [segments[s] for s in sorted(segments)]
+        concat_segments([segment for segment, _ in ordered], out)
+        expected = [c for _, checksums in ordered for c in checksums]
+        if frame_checksums(out) != expected:
+            raise Exception(f"The frames of {out} differ from the ones of the segments")
+
+
+USAGE = (
+    "python3 pyrffect_cluster.py coordinator input_xml [-a --address host:port] "
+    "[-w --workers w] [-c --chunk c] [-k --key k] [-o --out o] [-f --framerate f] "
+    "[-d --duration d] [-s --seed s] [-t --timeout t]\n"
+    "python3 pyrffect_cluster.py worker host:port [-k --key k]"
+)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("coordinator", "worker"):
+        print(USAGE, file=sys.stderr)
+        sys.exit(2)
+    mode, target = sys.argv[1], sys.argv[2]
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[3:],
+            "a:w:c:k:o:f:d:s:t:",
+            [
+                "address=",
+                "workers=",
+                "chunk=",
+                "key=",
+                "out=",
+                "framerate=",
+                "duration=",
+                "seed=",
+                "timeout=",
+            ],
+        )
+    except getopt.GetoptError as e:
+        print(e, USAGE, sep="\n", file=sys.stderr)
+        sys.exit(2)
+    authkey = None
+    for o, a in opts:
+        if o in ("-k", "--key"):
+            authkey = a.encode()
+
+    if mode == "worker":
+        if authkey is None:
+            print("The key of the coordinator is needed (-k --key)", file=sys.stderr)
+            sys.exit(2)
+        work(parse_address(target), authkey)
+        sys.exit(0)
+
+    root = Et.parse(target).getroot()
+    framerate, duration, out = 60, 10, "res.mp4"
+    address, workers, chunk, timeout = ("localhost", 0), 0, CHUNK, TIMEOUT
+    if "duration" in root.attrib:
+        duration = int(root.attrib["duration"])
+    if "framerate" in root.attrib:
+        framerate = int(root.attrib["framerate"])
+    if "out" in root.attrib:
+        out = root.attrib["out"]
+    seed = None
+    if "seed" in root.attrib:
+        seed = int(root.attrib["seed"])
+    for o, a in opts:
+        if o in ("-a", "--address"):
+            address = parse_address(a)
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-c", "--chunk"):
+            chunk = int(a)
+        elif o in ("-o", "--out"):
+            out = a
+        elif o in ("-f", "--framerate"):
+            framerate = int(a)
+        elif o in ("-d", "--duration"):
+            duration = int(a)
+        elif o in ("-s", "--seed"):
+            seed = int(a)
+        elif o in ("-t", "--timeout"):
+            timeout = float(a)
+    if not out.endswith(".mp4"):
+        out += ".mp4"
+    if seed is None:
+        # drawn once here, every worker has to render with the same seed
+        seed = np.random.SeedSequence().entropy
+    if authkey is None:
+        # the connections carry pickles, whoever knows the key can run code on
+        # the coordinator and its workers, so there is no default one
+        key = secrets.token_hex(16)
+        print(f"Key of the workers: {key}")
+        authkey = key.encode()
+
+    try:
+        coordinate(
+            target,
+            seed,
+            out,
+            framerate,
+            duration * framerate,
+            address,
+            authkey,
+            chunk,
+            workers,
+            timeout=timeout,
+        )
+    except Exception as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print("Success of the video creation")
+    sys.exit(0)
@@ -1,62 +1,216 @@
 from PIL import Image
 import numpy as np
+import math
+
+
+
+def draw_ray(buffer, x0, y0, x1, y1, width, color):
+    # Anti-aliased segment of the given width with flat ends, drawn in place on a
+    # float32 RGBA buffer whose alpha is in [0, 1]. Pixel centers are at integer
+    # coordinates. The segment is cut in pieces so that only the pixels around it
+    # are computed, the coverage of a piece being taken from the whole segment.
+    # Returns the box (x, y, fx, fy) of the touched pixels, None if none is.
+    height, buffer_width, _ = buffer.shape
+    half = width / 2
+    dx, dy = x1 - x0, y1 - y0
+    length = math.hypot(dx, dy)
+    if length < 1e-6:
+        ux, uy = 1.0, 0.0
+    else:
+        ux, uy = dx / length, dy / length
+    margin = half + 1
+    step = max(4 * margin, 16)
+    box = None
+    start = 0.0
+    while True:
+        end = min(start + step, length)
+        xa, ya = x0 + ux * start, y0 + uy * start
+        xb, yb = x0 + ux * end, y0 + uy * end
+        bx = max(int(math.floor(min(xa, xb) - margin)), 0)
+        by = max(int(math.floor(min(ya, yb) - margin)), 0)
+        bfx = min(int(math.ceil(max(xa, xb) + margin)) + 1, buffer_width)
+        bfy = min(int(math.ceil(max(ya, yb) + margin)) + 1, height)
+        if bfx > bx and bfy > by:
+            px = np.arange(bx, bfx, dtype=np.float32) - np.float32(x0)
+            py = (np.arange(by, bfy, dtype=np.float32) - np.float32(y0))[:, None]
+            along = px * np.float32(ux) + py * np.float32(uy)
+            across = np.abs(py * np.float32(ux) - px * np.float32(uy))
+            # overlap of the pixel with the segment, across then along it, which
+            # stays right for rays thinner or shorter than a pixel
+            cover = np.minimum(across + 0.5, half) - np.maximum(across - 0.5, -half)
+            np.clip(cover, 0, 1, out=cover)
+            ends = np.minimum(along + 0.5, length) - np.maximum(along - 0.5, 0)
+            cover *= np.clip(ends, 0, 1)
+            region = buffer[by:bfy, bx:bfx]
+            region[:, :, :3] = color[:3]
+            np.maximum(region[:, :, 3], cover, out=region[:, :, 3])
+            if box is None:
+                box = (bx, by, bfx, bfy)
+            else:
+                box = (
+                    min(box[0], bx),
+                    min(box[1], by),
+                    max(box[2], bfx),
+                    max(box[3], bfy),
+                )
+        if end >= length:
+            return box
+        start = end
+
+
+def draw_doubled_ray(buffer, x0, y0, x1, y1, width, color, scale=1.0):
+    # draw_ray of the ray PIL drew on an image doubled then downsampled, with its
+    # coordinates and width on the doubled image at full scale. PIL truncated
+    # the ends and filled the pixels from one to the other both included, a ray
+    # whose ends fall on one pixel being that pixel; a wide ray was a polygon
+    # whose sides were offset by rounded vectors, which makes it thinner or
+    # thicker than width depending on its direction. The doubled pixel i is
+    # centered at (i - 0.5) / 2 once downsampled.
+    x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+    dx, dy = x1 - x0, y1 - y0
+    length = math.hypot(dx, dy)
+    sx, sy = 0.5, 0.5
+    if length == 0:
+        ux, uy, thickness = 1.0, 0.0, 1.0
+    elif width <= 1:
+        ux, uy = dx / length, dy / length
+        # a pixel for each row or column along the main direction
+        thickness = 1 / max(abs(ux), abs(uy))
+    else:
+        ux, uy = dx / length, dy / length
+        half = (width - 1) / 2
+        outer = math.floor(half + 0.5) / length
+        inner = math.ceil(half - 0.5) / length
+        outer_x, outer_y = pil_round(dx * outer), pil_round(dy * outer)
+        inner_x, inner_y = pil_round(dx * inner), pil_round(dy * inner)
+        thickness = (
+            (outer_x + inner_x) * ux
+            + (outer_y + inner_y) * uy
+            # the pixels on the edges of the polygon are filled as well
+            + (abs(uy) if dy != 0 else 1)
+        )
+        # an even width has one more pixel on a side
+        sx -= (outer_y - inner_y) / 2
+        sy -= (outer_x - inner_x) / 2
+    scale /= 2
+    return draw_ray(
+        buffer,
+        (x0 - 0.5 * ux - sx) * scale,
+        (y0 - 0.5 * uy - sy) * scale,
+        (x1 + 0.5 * ux - sx) * scale,
+        (y1 + 0.5 * uy - sy) * scale,
+        thickness * scale,
+        color,
+    )
 
 
+def pil_round(f):
+    # nearest integer, halves towards 0 as PIL rounds them
+    return int(math.copysign(math.ceil(abs(f) - 0.5), f))
 
-def rgb_to_tsv(buffer):
-    alpha = buffer[:, :, 3]
-    # buffer = buffer / 255.0  # tmp
-    maxi = np.max(buffer[:, :, :3], axis=-1)
-    mini = np.min(buffer[:, :, :3], axis=-1)
 
-    s = np.full(buffer.shape[:-1], 0, dtype=np.float32)
+def premultiply(buffer):
+    # in place, from straight to premultiplied alpha
+    np.multiply(buffer[:, :, :3], buffer[:, :, 3, None], out=buffer[:, :, :3])
 
-    mask = maxi > 0.0001
-    with np.errstate(divide='ignore', invalid='ignore'):
-        s[mask] = (1 - mini / maxi)[mask]
-    v = maxi / 255
-    delta = np.divide(
-        np.full(maxi.shape, 60, dtype=np.float32),
-        (maxi - mini),
-        out=np.full(maxi.shape, 0, dtype=np.float32),
-        where=np.abs(maxi - mini) > 0.25,
+
+def unpremultiply(buffer):
+    # in place, the colors of the transparent pixels are left to 0
+    np.divide(
+        buffer[:, :, :3],
+        buffer[:, :, 3, None],
+        out=buffer[:, :, :3],
+        where=buffer[:, :, 3, None] > 0,
     )
 
-    t = np.full(buffer.shape[:-1], 0, dtype=np.float32)
-
-    # non_mask = np.logical_not(np.isclose(mini, maxi))
-
-    mask = np.isclose(maxi, buffer[:, :, 1])
-    # mask = np.logical_and(np.isclose(maxi, buffer[:, :, 1]), non_mask)
-    t[mask] = ((buffer[:, :, 2] - buffer[:, :, 0]) * delta + 120)[mask]
-    mg = mask
-
-    mask = np.isclose(maxi, buffer[:, :, 2])
-    # mask = np.logical_and(np.isclose(maxi, buffer[:, :, 2]), non_mask)
-    t[mask] = ((buffer[:, :, 0] - buffer[:, :, 1]) * delta + 240)[mask]
-    mb = mask
-
-    mask = np.isclose(maxi, buffer[:, :, 0])
-    # mask = np.logical_and(np.isclose(maxi, buffer[:, :, 0]), non_mask)
-    t[mask] = (((buffer[:, :, 1] - buffer[:, :, 2]) * delta + 360) % 360)[
-        mask
-    ]  # in last so that mini == maxi does 0
-    return t, s, v, alpha
-
-
-def tsv_to_rgb(t, s, v, alpha):
-    t_i = (t / 60).astype(np.int) % 6
-    f = t / 60 - t_i
-    l = v * (1 - s)
-    m = v * (1 - f * s)
-    n = v * (1 - (1 - f) * s)
-    # print(f.dtype, l.dtype, m.dtype, n.dtype, v.dtype, t_i.dtype)
-    r = np.choose(t_i, [v, m, l, l, n, v]) * 255
-    g = np.choose(t_i, [n, v, v, m, l, l]) * 255
-    b = np.choose(t_i, [l, l, n, v, v, m]) * 255
-    # print(np.max(r), np.max(g), np.max(b))
-    # print(np.min(r), np.min(g), np.min(b))
-    return np.stack((r, g, b, alpha), axis=-1)
+
+def tsv_buffers(shape):
+    # output (t, s, v) and scratch buffers of rgb_to_tsv and tsv_to_rgb for
+    # images of the given (height, width)
+    return (
+        tuple(np.empty(shape, dtype=np.float32) for _ in range(3)),
+        (
+            np.empty(shape, dtype=np.float32),
+            np.empty(shape, dtype=np.float32),
+            np.empty(shape, dtype=bool),
+            np.empty(shape, dtype=bool),
+        ),
+    )
+
+
+# rgb_to_tsv and tsv_to_rgb work in float32 without allocating when given their
+# buffers. Compared to the former numpy.isclose/numpy.choose versions, t, s and v
+# are identical on integer channels such as the ones of the images; otherwise the
+# maximum channel is found by equality instead of closeness, which only changes
+# the arbitrary hue (0, 120 or 240) of the nearly grey pixels. tsv_to_rgb is
+# within 1e-3 of the former version on the 0-255 channels (pyrffect_bench.py).
+
+
+def rgb_to_tsv(buffer, out=None, scratch=None):
+    # hue t in [0, 360), saturation s and value v in [0, 1]; the hue of the
+    # red channel prevails on the blue one, which prevails on the green one
+    if out is None or scratch is None:
+        out, scratch = tsv_buffers(buffer.shape[:-1])
+    t, s, v = out
+    work, offset, mask, mask_b = scratch
+    r, g, b = buffer[:, :, 0], buffer[:, :, 1], buffer[:, :, 2]
+
+    np.maximum(r, g, out=v)
+    np.maximum(v, b, out=v)
+    np.minimum(r, g, out=s)
+    np.minimum(s, b, out=s)
+    np.subtract(v, s, out=work)
+
+    np.greater(v, 0.0001, out=mask)
+    np.divide(s, v, out=s, where=mask)
+    np.subtract(1, s, out=s)
+    np.logical_not(mask, out=mask)
+    np.copyto(s, 0, where=mask)
+
+    # 60 / (maxi - mini), null for the nearly grey pixels
+    np.greater(work, 0.25, out=mask)
+    np.divide(60, work, out=work, where=mask)
+    np.logical_not(mask, out=mask)
+    np.copyto(work, 0, where=mask)
+
+    np.equal(v, b, out=mask_b)
+    np.equal(v, r, out=mask)
+    np.subtract(b, r, out=t)
+    np.subtract(r, g, out=t, where=mask_b)
+    np.subtract(g, b, out=t, where=mask)
+    np.multiply(t, work, out=t)
+    offset.fill(120)
+    np.copyto(offset, 240, where=mask_b)
+    np.copyto(offset, 360, where=mask)
+    np.add(t, offset, out=t)
+    np.remainder(t, 360, out=t)
+
+    np.divide(v, 255, out=v)
+    return t, s, v, buffer[:, :, 3]
+
+
+def tsv_to_rgb(t, s, v, alpha, out=None, scratch=None):
+    # channel n of (r: 5, g: 3, b: 1) is v - v * s * clip(min(k, 4 - k), 0, 1)
+    # with k = (n + t / 60) % 6, which gives the six sectors of the hue at once
+    if out is None:
+        out = np.empty(t.shape + (4,), dtype=np.float32)
+    if scratch is None:
+        _, scratch = tsv_buffers(t.shape)
+    vs, k = scratch[0], scratch[1]
+    np.multiply(v, s, out=vs)
+    for channel, n in enumerate((5, 3, 1)):
+        result = out[:, :, channel]
+        np.divide(t, 60, out=k)
+        np.add(k, n, out=k)
+        np.remainder(k, 6, out=k)
+        np.subtract(4, k, out=result)
+        np.minimum(k, result, out=k)
+        np.clip(k, 0, 1, out=k)
+        np.multiply(k, vs, out=k)
+        np.subtract(v, k, out=result)
+        np.multiply(result, 255, out=result)
+    np.copyto(out[:, :, 3], alpha)
+    return out
 
 
 if __name__ == "__main__":
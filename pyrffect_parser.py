@@ -1,13 +1,19 @@
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from calc import Calc
 from firework import Firework
 from fusion_mode import FusionMode
 from fusion_linear import FusionLinear
+from fusion_premultiplied import FusionPremultiplied
 from imagecalc import ImageCalc
 from lighteffect import LightEffect
 from pixelmove import PixelMove
 from pyrffects import Pyrffect
+from pyrffect_pool import compute_parallel
+from pyrffect_trace import Tracer
+from pyrffect_strips import STRIPS
+from pyrffect_cache import ASSETS
 from flat import Flat
 import xml.etree.ElementTree as Et
 import getopt
@@ -27,6 +33,7 @@ calc_types = {
 fusions = {
     "flat": FusionMode,
     "linear": FusionLinear,
+    "premultiplied": FusionPremultiplied,
 }
 
 named_effects = {}
@@ -52,8 +59,39 @@ def parse_effects(nd: Et.Element, calc: Calc):
         calc.add_effect(new_effect)
 
 
+def load_images(nd: Et.Element, scale: float):
+    # the images of the calcs decoded concurrently, once per file
+    filenames = set()
+    for child_node in nd:
+        if calc_types.get(child_node.tag) is ImageCalc:
+            if "filename" in child_node.attrib:
+                filenames.add(child_node.attrib["filename"])
+    if len(filenames) == 0:
+        return {}
+    workers = min(len(filenames), os.cpu_count() or 1)
+    with ThreadPoolExecutor(workers, thread_name_prefix="pyrffect-load") as pool:
+        buffers = pool.map(lambda f: ImageCalc.load(f, scale), filenames)
+        return dict(zip(filenames, buffers))
+
+
+def visible_part(calc: Calc, w, h):
+    # part of the calc on the canvas, None when the whole calc is; a negative
+    # w or h is the fixed size of the canvas
+    x, y = calc.coords
+    box = (
+        max(-x, 0),
+        max(-y, 0),
+        calc.width if w is None or w >= 0 else min(calc.width, -w - x),
+        calc.height if h is None or h >= 0 else min(calc.height, -h - y),
+    )
+    if box == (0, 0, calc.width, calc.height) or box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    return box
+
+
 def parse_calc(nd: Et.Element, w, h, master=None):
     results_elem = []
+    images = load_images(nd, 1.0 if master is None else master.scale)
     for child_node in nd:
         if child_node.tag not in calc_types:
             raise Exception("Unknown calcs type")
@@ -71,9 +109,17 @@ def parse_calc(nd: Et.Element, w, h, master=None):
         if "order" in child_node.attrib:
             order = child_node.attrib["order"]
             child_node.attrib.pop("order")
-        new_calc = calc_types[child_node.tag](
-            master=master, coords=(x, y), **child_node.attrib
-        )
+        attrib = dict(child_node.attrib)
+        if calc_types[child_node.tag] is ImageCalc and "filename" in attrib:
+            attrib["buffer"] = images[attrib["filename"]]
+        new_calc = calc_types[child_node.tag](master=master, coords=(x, y), **attrib)
+        if isinstance(new_calc, ImageCalc) and len(child_node) == 0:
+            # without effect, the image is only seen through the canvas; the
+            # effects could depend on the size of the whole image
+            box = visible_part(new_calc, w, h)
+            if box is not None:
+                new_calc.crop(*box)
+        x, y = new_calc.coords
         w, h = compare_wh(w, h, x, y, new_calc.width, new_calc.height)
         parse_effects(child_node, new_calc)
 
@@ -81,58 +127,65 @@ def parse_calc(nd: Et.Element, w, h, master=None):
     return results_elem, w, h
 
 
-if __name__ == "__main__":
-    DEBUG = False
-    if DEBUG:
-        import cProfile, pstats
+def load_pyrffect(filename: str, scale: float = 1.0):
+    return parse_pyrffect(Et.parse(filename).getroot(), scale)
 
-    if len(sys.argv) < 2:
-        print("No file given", file=sys.stderr)
-        sys.exit(2)
-    filename = sys.argv[1]
-    print(f"Reading {filename}")
-    tree = Et.parse(filename)
 
-    root = tree.getroot()
+def parse_pyrffect(root: Et.Element, scale: float = 1.0):
+    # with scale, a smaller preview of the scene
     if root.tag != "Pyrffect":
-        print("This is not a pyrffect XML.", file=sys.stderr)
-        sys.exit(2)
+        raise Exception("This is not a pyrffect XML.")
     w, h = None, None
     if "width" in root.attrib:
-        w = -int(root.attrib["width"])
+        w = -int(round(int(root.attrib["width"]) * scale))
     if "height" in root.attrib:
-        h = -int(root.attrib["height"])
+        h = -int(round(int(root.attrib["height"]) * scale))
     p = Pyrffect("OUT", "img{}.png")
+    p.set_scale(scale)
     effects["named"] = p.get_named_effect
 
-    try:
-        calcs, w, h = parse_calc(root, w, h, master=p)
-    except Exception as e:
-        if DEBUG:
-            raise e
-        print(e, file=sys.stderr)
-        sys.exit(1)
+    calcs, w, h = parse_calc(root, w, h, master=p)
 
     w = 0 if w is None else w
     h = 0 if h is None else h
     w, h = abs(w), abs(h)
-    if not os.path.exists("OUT"):
-        os.mkdir("OUT")
-    print(w, h)
     p.set_dim(w, h)
     if "fusion_mode" in root.attrib:
         fusion = root.attrib["fusion_mode"]
         if fusion not in fusions:
-            print("No corresponding fusion mode", file=sys.stderr)
-            sys.exit(2)
+            raise Exception("No corresponding fusion mode")
         p.set_fusionmode(fusions[fusion]())
+    if "seed" in root.attrib:
+        p.set_seed(int(root.attrib["seed"]))
 
     for c, order in calcs:
         p.add_calc(c, order)
+    return p
+
+
+if __name__ == "__main__":
+    DEBUG = False
+    if DEBUG:
+        import cProfile, pstats
+
+    if len(sys.argv) < 2:
+        print("No file given", file=sys.stderr)
+        sys.exit(2)
+    filename = sys.argv[1]
+    print(f"Reading {filename}")
+    tree = Et.parse(filename)
+
+    root = tree.getroot()
 
     framerate = 60
     duration = 10
     out = "res.mp4"
+    jobs = 1
+    trace = None
+    start_frame, end_frame = 0, None
+    snapshot_every, resume, single_frame = 0, False, None
+    seed, scale, preset = None, 1.0, None
+    threads, strip_height, layer_threads = 1, None, 1
     if "duration" in root.attrib:
         duration = int(root.attrib["duration"])
     if "framerate" in root.attrib:
@@ -142,10 +195,30 @@ if __name__ == "__main__":
 
     opts, args = getopt.getopt(
         sys.argv[2:],
-        "f:d:o:",
-        ["duration=", "framerate=", "out="],
+        "f:d:o:j:s:t:",
+        [
+            "duration=",
+            "framerate=",
+            "out=",
+            "jobs=",
+            "seed=",
+            "trace=",
+            "start-frame=",
+            "end-frame=",
+            "snapshot-every=",
+            "resume",
+            "frame=",
+            "scale=",
+            "preset=",
+            "threads=",
+            "strip-height=",
+            "layer-threads=",
+            "cache=",
+            "cache-size=",
+            "no-cache",
+        ],
     )
-    for o, a in zip(opts, args):
+    for o, a in opts:
         print(o, a)
         if o in ("-f", "--framerate"):
             framerate = int(a)
@@ -153,22 +226,121 @@ if __name__ == "__main__":
             duration = int(a)
         elif o in ("-o", "--out"):
             out = a
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o in ("-s", "--seed"):
+            seed = int(a)
+        elif o in ("-t", "--trace"):
+            trace = a
+        elif o == "--start-frame":
+            start_frame = int(a)
+        elif o == "--end-frame":
+            end_frame = int(a)
+        elif o == "--snapshot-every":
+            snapshot_every = int(a)
+        elif o == "--resume":
+            resume = True
+        elif o == "--frame":
+            single_frame = int(a)
+        elif o == "--scale":
+            # quick look at the scene, encoded as fast as possible
+            scale = float(a)
+            if preset is None:
+                preset = "ultrafast"
+        elif o == "--preset":
+            preset = a
+        elif o == "--threads":
+            threads = int(a)
+        elif o == "--strip-height":
+            strip_height = int(a)
+        elif o == "--layer-threads":
+            layer_threads = int(a)
+        elif o == "--cache":
+            ASSETS.configure(a)
+        elif o == "--cache-size":
+            ASSETS.configure(ASSETS.directory, int(a) << 20)
+        elif o == "--no-cache":
+            ASSETS.configure(None)
+    STRIPS.configure(threads, strip_height)
+
+    # the scale is needed as soon as the calcs are created
+    try:
+        p = parse_pyrffect(root, scale)
+    except Exception as e:
+        if DEBUG:
+            raise e
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if seed is not None:
+        p.set_seed(seed)
+    p.set_preset(preset)
+    p.set_layer_workers(layer_threads)
+
+    if not os.path.exists("OUT"):
+        os.mkdir("OUT")
+    print(p.width, p.height)
     if not out.endswith(".mp4"):
         out += ".mp4"
-    
+    # frames [start_frame, end_frame) of the video, as a segment of its own
+    if end_frame is None:
+        end_frame = duration * framerate
+    tracer = None
+    if trace is not None:
+        # the workers of compute_parallel can not report their timings
+        if jobs > 1:
+            print("Tracing renders on a single process", file=sys.stderr)
+            jobs = 1
+        tracer = Tracer()
+        p.set_tracer(tracer)
+    if snapshot_every > 0 or resume or single_frame is not None:
+        if single_frame is not None or (resume and os.path.exists(out)):
+            # the frames have to come from the animation of out
+            try:
+                p.recover_seed(out)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+        # the snapshots kept along out are used again by the next runs
+        p.set_snapshots(snapshot_every, out + ".snapshots", filename)
+        if jobs > 1:
+            print("Snapshots are only kept on a single process", file=sys.stderr)
+            jobs = 1
+
+    if single_frame is not None:
+        p.render_frame(single_frame)
+        print(f"Frame {single_frame} saved in {p.output_directory}")
+        sys.exit(0)
+
     try:
         if DEBUG:
-            cProfile.run("p.compute(out, framerate, duration * framerate)", "stats")
+            cProfile.run("p.compute(out, framerate, end_frame, start_frame)", "stats")
             stat = pstats.Stats("stats")
             stat.strip_dirs()
             stat.dump_stats("pstats")
+        elif jobs > 1:
+            compute_parallel(
+                p,
+                load_pyrffect,
+                (filename, scale),
+                out,
+                framerate,
+                end_frame,
+                jobs,
+                start=start_frame,
+            )
+        elif resume:
+            p.resume(out, framerate, end_frame, start_frame)
         else:
-            p.compute(out, framerate, duration * framerate)
+            p.compute(out, framerate, end_frame, start_frame)
     except KeyboardInterrupt:
         print("Only part of the images were generated")
         if p.last_valid is None:
             print("No valid images were created, stopping", file=sys.stderr)
             sys.exit(2)
         sys.exit(1)
+    finally:
+        if tracer is not None:
+            tracer.write(trace)
+            print(tracer.summary())
     print("Success of the video creation")
     sys.exit(0)
@@ -0,0 +1,95 @@
+from collections import deque
+from typing import Callable, List, Tuple
+import multiprocessing as mp
+
+from output_image import OutputImage
+from pyrffects import Pyrffect
+
+Loader_ = Callable[..., Pyrffect]
+
+# state of a worker process, built once by _init_worker
+_pyrffect: Pyrffect = None
+_output: OutputImage = None
+
+
+def _init_worker(loader: Loader_, loader_args: tuple, seed: int):
+    global _pyrffect, _output
+    _pyrffect = loader(*loader_args)
+    _pyrffect.set_seed(seed)
+    _output = OutputImage(
+        _pyrffect.width, _pyrffect.height, 0, None, _pyrffect.fusion_mode
+    )
+
+
+def _render_chunk(start: int, end: int) -> Tuple[int, List[bytes]]:
+    # a worker receives increasing chunks, so seek only simulates the gap
+    # between its last chunk and this one
+    _pyrffect.seek(start)
+    frames = []
+    for _ in range(start, end):
+        _pyrffect.render(_output)
+        frames.append(_output.frame().tobytes())
+        _output.reset()
+    return start, frames
+
+
+def compute_parallel(
+    pyrffect: Pyrffect,
+    loader: Loader_,
+    loader_args: tuple,
+    out: str,
+    framerate: int,
+    frame: int,
+    jobs: int,
+    chunk: int = 16,
+    start: int = 0,
+    pipeline: int = 2,
+):
+    # Render the frames [start, frame) on `jobs` processes. Every worker rebuilds
+    # the scene with loader(*loader_args), so the loader must be a module level
+    # function. The seed being shared, the frames are identical to the ones of
+    # Pyrffect.compute whatever the number of workers.
+    if pyrffect.width is None or pyrffect.height is None:
+        raise Exception("No valid dimension to compite the pyrffect.")
+    if pyrffect.seed is None:
+        pyrffect.start()
+    pyrffect.save_seed(out)
+    output_result = OutputImage(
+        pyrffect.width,
+        pyrffect.height,
+        framerate,
+        out,
+        pyrffect.fusion_mode,
+        pipeline,
+        pyrffect.preset,
+    )
+    chunks = iter(range(start, frame, chunk))
+    total = frame - start
+    pyrffect.last_valid = None
+    with mp.Pool(
+        jobs, initializer=_init_worker, initargs=(loader, loader_args, pyrffect.seed)
+    ) as pool:
+        # bounded number of chunks in flight, so that the workers can not run
+        # too far ahead of the ffmpeg pipe
+        pending = deque()
+
+        def submit():
+            s = next(chunks, None)
+            if s is not None:
+                pending.append(
+                    pool.apply_async(_render_chunk, (s, min(s + chunk, frame)))
+                )
+
+        for _ in range(2 * jobs):
+            submit()
+        try:
+            while pending:
+                first, frames = pending.popleft().get()
+                submit()
+                for i, f in enumerate(frames):
+                    output_result.write(f, first + i + 1 - start, total)
+                    pyrffect.last_valid = first + i
+        except BaseException:
+            output_result.close(raise_error=False)
+            raise
+        output_result.close()
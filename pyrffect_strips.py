@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, List, Tuple
+
+Kernel_ = Callable[[int, int], None]
+
+
+class StripPool:
+    # Row strips of a layer processed on a shared pool of threads. The kernels
+    # given to run are elementwise numpy code, which releases the GIL, and each
+    # strip works on its own rows of the buffers, scratch ones included.
+    workers: int
+    strip_height: int
+    executor: ThreadPoolExecutor
+
+    def __init__(self, workers: int = 1, strip_height: int = 64) -> None:
+        self.workers = workers
+        self.strip_height = strip_height
+        self.executor = None
+
+    def configure(self, workers: int, strip_height: int = None):
+        if strip_height is not None:
+            self.strip_height = max(strip_height, 1)
+        if workers != self.workers and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.workers = max(workers, 1)
+
+    def strips(self, height: int) -> List[Tuple[int, int]]:
+        step = self.strip_height
+        return [(y, min(y + step, height)) for y in range(0, height, step)]
+
+    def run(self, kernel: Kernel_, height: int):
+        # kernel(y, fy) over the rows [0, height), on the calling thread when a
+        # single strip or worker would do
+        if self.workers <= 1 or height <= self.strip_height:
+            kernel(0, height)
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="pyrffect-strip"
+            )
+        futures = [self.executor.submit(kernel, y, fy) for y, fy in self.strips(height)]
+        # every strip is done before an error is raised
+        wait(futures)
+        for future in futures:
+            future.result()
+
+
+STRIPS = StripPool()
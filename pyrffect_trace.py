@@ -0,0 +1,93 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+
+class NullTracer:
+    # tracer doing nothing, used when no tracing is asked
+    enabled: bool = False
+    frame: int = 0
+
+    def __init__(self) -> None:
+        self.nothing = contextlib.nullcontext()
+
+    def span(self, name: str, category: str, pixels: int = 0, frame: int = None):
+        return self.nothing
+
+
+class Tracer(NullTracer):
+    # Wall time of the stages of the frames, exported as Chrome trace events
+    # (chrome://tracing, Perfetto) and as a summary per stage. frame is set by
+    # Pyrffect.render and given with every event, unless a span is about
+    # another frame than the one being rendered.
+    enabled: bool = True
+    events: List[dict]
+    origin: float
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.events = []
+        self.origin = time.perf_counter()
+        self.frame = 0
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, pixels: int = 0, frame: int = None):
+        if frame is None:
+            frame = self.frame
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - self.origin) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    # numpy integers would not be serializable
+                    "args": {"frame": int(frame), "pixels": int(pixels)},
+                }
+            )
+
+    def write(self, filename: str):
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def stages(self) -> Dict[Tuple[str, str], Tuple[int, float, int]]:
+        # (category, name) -> (calls, seconds, pixels)
+        stages = {}
+        for e in self.events:
+            key = (e["cat"], e["name"])
+            calls, seconds, pixels = stages.get(key, (0, 0.0, 0))
+            stages[key] = (
+                calls + 1,
+                seconds + e["dur"] / 1e6,
+                pixels + e["args"]["pixels"],
+            )
+        return stages
+
+    def summary(self) -> str:
+        lines = [
+            f"{'stage':>10} {'name':<32} {'calls':>7} {'total ms':>10}"
+            f" {'mean ms':>9} {'Mpx/s':>9}"
+        ]
+        stages = sorted(self.stages().items(), key=lambda s: -s[1][1])
+        for (category, name), (calls, seconds, pixels) in stages:
+            rate = ""
+            if pixels > 0 and seconds > 0:
+                rate = f"{pixels / seconds / 1e6:9.2f}"
+            lines.append(
+                f"{category:>10} {name[:32]:<32} {calls:>7} {seconds * 1000:10.2f}"
+                f" {seconds * 1000 / calls:9.3f} {rate:>9}"
+            )
+        return "\n".join(lines)
+
+
+NULL_TRACER = NullTracer()
@@ -1,13 +1,32 @@
-from typing import Any, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Set, Tuple
+import hashlib
+import os
+import pickle
+import numpy as np
 from calc import Calc
-from output_image import OutputImage
+from output_image import OutputImage, concat_segments, frame_checksums
 from effect import Effect
 from fusion_linear import FusionMode
+from staticcalc import StaticCalc
+from pyrffect_trace import NULL_TRACER, NullTracer
 
 CalcPos = Dict[str, int]
 Couche = Tuple[int, Calc]
 
 
+class LayerPastes:
+    # output of a calc computed away from the canvas, its pastes being done
+    # afterwards in the order of the layers
+    calcs: List[Calc]
+
+    def __init__(self) -> None:
+        self.calcs = []
+
+    def paste_on(self, calc: Calc):
+        self.calcs.append(calc)
+
+
 class Pyrffect:
     calcs: Dict[str, Couche]
 
@@ -22,8 +41,24 @@ class Pyrffect:
     height: int
     last_valid: int
 
+    seed: int
+    frame: int
+    ordered_calcs: List[Calc]
+    background: np.ndarray
+
     size_listener: List[Calc]
     named_effect: Dict[str, Effect]
+    named_owner: Dict[str, Calc]
+    tracer: NullTracer
+    snapshot_every: int
+    snapshots: Dict[int, dict]
+    snapshot_file: str
+    snapshot_key: tuple
+    scale: float
+    preset: str
+    layer_workers: int
+    layer_executor: ThreadPoolExecutor
+    dependencies: List[Set[int]]
 
     def __init__(
         self,
@@ -31,6 +66,7 @@ class Pyrffect:
         output_fileformat: str,
         width: int = None,
         height: int = None,
+        seed: int = None,
     ):
         self.calcs = {}
         self.calc_seq = 0
@@ -42,10 +78,55 @@ class Pyrffect:
         self.last_valid = None
         self.size_listener = []
         self.named_effect = {}
+        self.named_owner = {}
+        self.seed = seed
+        self.frame = 0
+        self.ordered_calcs = None
+        self.background = None
+        self.tracer = NULL_TRACER
+        self.snapshot_every = 0
+        self.snapshots = {}
+        self.snapshot_file = None
+        self.snapshot_key = None
+        self.scale = 1.0
+        self.preset = None
+        self.layer_workers = 1
+        self.layer_executor = None
+        self.dependencies = None
+
+    def set_scale(self, scale: float):
+        # scale of a preview, to be set before the calcs are created: they take
+        # their coordinates and sizes at full scale and scale them down
+        self.scale = scale
+
+    def set_preset(self, preset: str):
+        # x264 preset of the videos, the default one when None
+        self.preset = preset
+
+    def set_tracer(self, tracer: NullTracer):
+        # tracer receives the timings of the stages of the next rendered frames,
+        # NULL_TRACER stops the tracing
+        self.tracer = tracer
+        calcs = [c for (_, c) in self.calcs.values()]
+        for c in calcs + (self.ordered_calcs or []):
+            c.tracer = tracer
+
+    def set_layer_workers(self, workers: int):
+        # number of threads computing the layers of a frame, 1 to compute them
+        # one after the other on the calling thread
+        if workers != self.layer_workers and self.layer_executor is not None:
+            self.layer_executor.shutdown()
+            self.layer_executor = None
+        self.layer_workers = max(workers, 1)
 
-    def add_named_effect(self, name: str, effect: Effect):
+    def add_named_effect(self, name: str, effect: Effect, owner: Calc = None):
+        # owner is the calc updating the effect, if any, before the calcs
+        # applying it read it
         if name not in self.named_effect:
             self.named_effect[name] = effect
+            self.named_owner[name] = owner
+            if self.width is not None and self.height is not None:
+                effect.set_canvas(self.width, self.height)
         else:
             raise Exception(f"Name '{name}' already attributed to another effect.")
 
@@ -76,10 +157,106 @@ class Pyrffect:
         self.height = height
         for listen_size in self.size_listener:
             listen_size.set_dim(width, height)
+        for effect in self.named_effect.values():
+            effect.set_canvas(width, height)
 
     def set_fusionmode(self, fusion_mode: FusionMode):
         self.fusion_mode = fusion_mode
 
+    def set_seed(self, seed: int):
+        self.seed = seed
+        # the next seek starts again from the first frame
+        self.ordered_calcs = None
+        self.snapshots = {}
+
+    def set_snapshots(self, every: int, filename: str = None, scene: str = None):
+        # Keep the state of the scene every `every` frames, so that seek restarts
+        # from the nearest snapshot before its frame. With filename, the snapshots
+        # are also saved there, and the ones saved by a former run of the same
+        # scene file, scale, calcs and seed are loaded back (its seed is taken
+        # when none is set); the others are dropped.
+        self.snapshot_every = every
+        self.snapshot_file = filename
+        self.snapshot_key = self.get_snapshot_key(scene)
+        self.snapshots = {}
+        if filename is None or not os.path.exists(filename):
+            return
+        with open(filename, "rb") as f:
+            saved = pickle.load(f)
+        if saved.get("key") != self.snapshot_key:
+            return
+        if self.seed is None:
+            self.set_seed(saved["seed"])
+        if saved["seed"] == self.seed:
+            self.snapshots = saved["snapshots"]
+
+    def get_snapshot_key(self, scene: str = None) -> tuple:
+        # what the states depend on besides the seed
+        source = None
+        if scene is not None:
+            with open(scene, "rb") as f:
+                source = (os.path.abspath(scene), hashlib.sha1(f.read()).hexdigest())
+        layout = tuple(type(c).__name__ for _, c in self.calcs.values())
+        return (source, self.scale, self.width, self.height, layout)
+
+    def save_seed(self, out: str):
+        # the seed of out next to it, a render without seed drawing a new one
+        with open(out + ".seed", "w") as f:
+            f.write(f"{self.seed}\n")
+
+    def recover_seed(self, out: str):
+        # takes the seed out was rendered with, so that its frames can be
+        # rendered again; fails when the seed is unknown or another one is set
+        saved = None
+        if os.path.exists(out + ".seed"):
+            with open(out + ".seed") as f:
+                saved = int(f.read())
+        if saved is None and self.seed is None:
+            raise Exception(f"The seed of {out} is unknown, give it with --seed")
+        if saved is not None and self.seed is not None and saved != self.seed:
+            raise Exception(
+                f"{out} was rendered with the seed {saved}, not {self.seed}"
+            )
+        if self.seed is None:
+            self.set_seed(saved)
+
+    def get_state(self) -> dict:
+        # the static calcs do not change from a frame to another
+        return {
+            "frame": self.frame,
+            "calcs": {i: c.get_state() for i, (_, c) in self.calcs.items()},
+            "named": {n: e.get_state() for n, e in self.named_effect.items()},
+        }
+
+    def set_state(self, state: dict):
+        if self.ordered_calcs is None:
+            self.start()
+        for i, calc_state in state["calcs"].items():
+            self.calcs[i][1].set_state(calc_state)
+        for name, effect_state in state["named"].items():
+            self.named_effect[name].set_state(effect_state)
+        self.frame = state["frame"]
+
+    def keep_snapshot(self):
+        if self.snapshot_every <= 0 or self.frame % self.snapshot_every != 0:
+            return
+        if self.frame in self.snapshots:
+            return
+        self.snapshots[self.frame] = self.get_state()
+        if self.snapshot_file is not None:
+            # replaced at once, an interruption leaves the former file
+            temporary = self.snapshot_file + ".tmp"
+            with open(temporary, "wb") as f:
+                pickle.dump(
+                    {
+                        "seed": self.seed,
+                        "key": self.snapshot_key,
+                        "snapshots": self.snapshots,
+                    },
+                    f,
+                )
+            os.replace(temporary, self.snapshot_file)
+
     def _fuse(self) -> List[Calc]:
         def fusion(l0, l1):
             result = []
@@ -94,6 +271,7 @@ class Pyrffect:
                     j += 1
             while i < s0:
                 result.append(l0[i])
+                i += 1
             while j < s1:
                 result.append(l1[j])
                 j += 1
@@ -110,18 +288,214 @@ class Pyrffect:
 
         return [(e) for (_, e) in split(calcs)]
 
-    def compute(self, out: str, framerate: int, frame: int):
+    def _schedule(self, ordered_calcs: List[Calc]) -> List[Calc]:
+        # The static calcs at the bottom are blended once into the background
+        # the output restarts from. The other runs of static calcs are merged
+        # into a StaticCalc when the fusion mode knows how to merge two layers.
+        output = OutputImage(self.width, self.height, 0, None, self.fusion_mode)
+        fusion_mode = output.fusion_mode
+        bottom = 0
+        while bottom < len(ordered_calcs) and ordered_calcs[bottom].is_static():
+            bottom += 1
+        self.background = None
+        if bottom > 0:
+            for c in ordered_calcs[:bottom]:
+                c.compute(output)
+            self.background = output.buffer
+        if not hasattr(fusion_mode, "merge"):
+            return ordered_calcs[bottom:]
+        scheduled = []
+        run = []
+        for c in ordered_calcs[bottom:]:
+            if c.is_static():
+                run.append(c)
+                continue
+            if len(run) > 0:
+                scheduled.append(StaticCalc(run, self.width, self.height, fusion_mode))
+                run = []
+            scheduled.append(c)
+        if len(run) > 0:
+            scheduled.append(StaticCalc(run, self.width, self.height, fusion_mode))
+        return scheduled
+
+    def _dependencies(self, ordered_calcs: List[Calc]) -> List[Set[int]]:
+        # Indexes of the layers each layer waits for in a frame. The calcs
+        # touching a named effect keep the order of the layers between them: the
+        # owner against each of the others, and the others between them unless
+        # the effect can be applied concurrently. The dependencies always go to
+        # lower indexes.
+        dependencies = [set() for _ in ordered_calcs]
+        position = {id(c): i for i, c in enumerate(ordered_calcs)}
+        for name, effect in self.named_effect.items():
+            users = [i for i, c in enumerate(ordered_calcs) if effect in c.effects]
+            owner = self.named_owner[name]
+            owner = position.get(id(owner)) if owner is not None else None
+            if owner is not None:
+                for i in users:
+                    if i != owner:
+                        dependencies[max(i, owner)].add(min(i, owner))
+            if not effect.concurrent:
+                for before, after in zip(users, users[1:]):
+                    dependencies[after].add(before)
+        return dependencies
+
+    def start(self):
+        # every calc gets its own random generator, derived from the seed and its
+        # index, so that a frame only depends on the seed and the frames before it
+        if self.seed is None:
+            self.seed = np.random.SeedSequence().entropy
+        for index in self.calcs:
+            self.calcs[index][1].set_seed(
+                np.random.SeedSequence(self.seed, spawn_key=(index,))
+            )
+        ordered_calcs = self._fuse()
+        premultiplied = self.fusion_mode is not None and self.fusion_mode.premultiplied
+        for c in ordered_calcs:
+            c.set_premultiplied(premultiplied)
+            c.reset()
+        self.ordered_calcs = self._schedule(ordered_calcs)
+        self.dependencies = self._dependencies(self.ordered_calcs)
+        self.set_tracer(self.tracer)
+        self.frame = 0
+
+    def seek(self, frame: int):
+        if self.ordered_calcs is None:
+            self.start()
+        nearest = max((s for s in self.snapshots if s <= frame), default=None)
+        if nearest is not None and (frame < self.frame or nearest > self.frame):
+            self.set_state(self.snapshots[nearest])
+        elif frame < self.frame:
+            self.start()
+        while self.frame < frame:
+            self.keep_snapshot()
+            self.new_frame()
+            for c in self.ordered_calcs:
+                c.skip()
+            self.frame += 1
+
+    def new_frame(self):
+        for effect in self.named_effect.values():
+            effect.new_frame()
+
+    def render(self, output: OutputImage):
+        if output.background is not self.background:
+            output.set_background(self.background)
+        self.keep_snapshot()
+        tracer = self.tracer
+        tracer.frame = self.frame
+        output.tracer = tracer
+        with tracer.span("frame", "frame"):
+            self.new_frame()
+            if self.layer_workers > 1 and len(self.ordered_calcs) > 1:
+                self.render_layers(output)
+            else:
+                for c in self.ordered_calcs:
+                    self.compute_layer(c, output)
+        self.frame += 1
+
+    def compute_layer(self, c: Calc, output):
+        area = c.out_buffer.shape[0] * c.out_buffer.shape[1]
+        with self.tracer.span(c.describe(), "layer", area):
+            c.compute(output)
+
+    def render_layers(self, output: OutputImage):
+        # The calcs are computed on the layer threads as soon as the layers they
+        # depend on are, each one on its own buffer. Only their pastes on the
+        # canvas are done here, in the order of the layers.
+        if self.layer_executor is None:
+            self.layer_executor = ThreadPoolExecutor(
+                self.layer_workers, thread_name_prefix="pyrffect-layer"
+            )
+        pastes = [LayerPastes() for _ in self.ordered_calcs]
+        futures = []
+
+        def stage(i: int):
+            # the futures waited for were submitted before this one, so they are
+            # already running or done
+            wait([futures[d] for d in self.dependencies[i]])
+            for d in self.dependencies[i]:
+                futures[d].result()
+            self.compute_layer(self.ordered_calcs[i], pastes[i])
+
+        for i in range(len(self.ordered_calcs)):
+            futures.append(self.layer_executor.submit(stage, i))
+        try:
+            for future, layer in zip(futures, pastes):
+                future.result()
+                for c in layer.calcs:
+                    output.paste_on(c)
+        finally:
+            wait(futures)
+
+    def compute(
+        self, out: str, framerate: int, frame: int, start: int = 0, pipeline: int = 2
+    ):
+        # pipeline is the number of rendered frames allowed to wait for ffmpeg
         if self.width is None or self.height is None:
             raise Exception("No valid dimension to compite the pyrffect.")
-        output_result = OutputImage(self.width, self.height, framerate, out, self.fusion_mode)
-        orderer_calc = self._fuse()
-        for c in orderer_calc:
-            c.reset()
+        output_result = OutputImage(
+            self.width,
+            self.height,
+            framerate,
+            out,
+            self.fusion_mode,
+            pipeline,
+            self.preset,
+        )
+        # a pyrffect already before start only simulates the frames in between
+        self.seek(start)
+        self.save_seed(out)
         self.last_valid = None
-        for i in range(frame):
-            filename = (self.output_directory + "/" + self.output_fileformat).format(i)
-            for c in orderer_calc:
-                c.compute(output_result)
-            output_result.save(i+1, frame)
-            output_result.reset()
-            self.last_valid = i
+        try:
+            for i in range(start, frame):
+                self.render(output_result)
+                with self.tracer.span("save", "frame"):
+                    output_result.save(i + 1 - start, frame - start)
+                output_result.reset()
+                self.last_valid = i
+        except BaseException:
+            # the error of the render, an interruption included, is the one
+            # reported rather than a failure of the writer it brought
+            output_result.close(raise_error=False)
+            raise
+        output_result.close()
+
+    def resume(
+        self, out: str, framerate: int, frame: int, start: int = 0, pipeline: int = 2
+    ):
+        # Carry on an interrupted compute of out: the frames already in out are
+        # kept, the next ones are rendered from the nearest snapshot to a second
+        # file then appended to out without encoding again.
+        done = len(frame_checksums(out)) if os.path.exists(out) else 0
+        if done == 0:
+            return self.compute(out, framerate, frame, start, pipeline)
+        self.recover_seed(out)
+        self.last_valid = start + done - 1
+        if start + done >= frame:
+            return
+        name, extension = os.path.splitext(out)
+        part, joined = name + ".part" + extension, name + ".joined" + extension
+        try:
+            self.compute(part, framerate, frame, start + done, pipeline)
+        finally:
+            # an interruption keeps the frames of part as well, out is only
+            # replaced once joined
+            if self.last_valid is not None:
+                concat_segments([out, part], joined)
+                os.replace(joined, out)
+            else:
+                self.last_valid = start + done - 1
+            for leftover in (part, part + ".seed"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def render_frame(self, frame: int, filename: str = None):
+        # the single image of frame, as a png in the output directory by default
+        if filename is None:
+            filename = os.path.join(
+                self.output_directory, self.output_fileformat.format(frame)
+            )
+        output = OutputImage(self.width, self.height, 0, None, self.fusion_mode)
+        self.seek(frame)
+        self.render(output)
+        output.save_as(filename)
@@ -0,0 +1,39 @@
+from typing import List
+import numpy as np
+from calc import Calc
+
+
+class StaticCalc(Calc):
+    # consecutive static calcs blended once into a single calc, so that a frame
+    # fuses one buffer instead of one per calc
+    calcs: List[Calc]
+
+    def __init__(self, calcs: List[Calc], width: int, height: int, fusion_mode):
+        self.calcs = calcs
+        regions = [self.region(c, width, height) for c in calcs]
+        x = min(r[0] for r in regions)
+        y = min(r[1] for r in regions)
+        fx = max(r[2] for r in regions)
+        fy = max(r[3] for r in regions)
+        super().__init__(coords=(x, y), master=None)
+        self.width = max(fx - x, 0)
+        self.height = max(fy - y, 0)
+        self.out_buffer = np.zeros((self.height, self.width, 4), dtype=np.float32)
+        for c, (cx, cy, cfx, cfy) in zip(calcs, regions):
+            if cfx <= cx or cfy <= cy:
+                continue
+            view = self.out_buffer[cy - y : cfy - y, cx - x : cfx - x]
+            view[:, :, :] = fusion_mode.merge(
+                view, c.out_buffer[: cfy - cy, : cfx - cx]
+            )
+
+    @staticmethod
+    def region(calc: Calc, width: int, height: int):
+        # part of the canvas covered by the calc, as clipped by OutputImage.paste_on
+        h, w, _ = calc.out_buffer.shape
+        w, h = min(w, calc.width), min(h, calc.height)
+        x, y = calc.coords
+        return x, y, min(width, x + w), min(height, y + h)
+
+    def is_static(self) -> bool:
+        return True
@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pyrffect_cache import ASSETS
+
+
+@pytest.fixture(autouse=True)
+def no_asset_cache():
+    # the tests never write to the cache of the user
+    directory = ASSETS.directory
+    ASSETS.configure(None)
+    yield
+    ASSETS.configure(directory)
+
+
+@pytest.fixture
+def scenes(monkeypatch):
+    # the images of the scenes are relative to their directory
+    monkeypatch.chdir(os.path.join(ROOT, "test"))
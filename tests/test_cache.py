@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pytest
+
+import pyrffect_cache
+from pyrffect_cache import AssetCache
+
+
+def test_failed_store_leaves_no_temporary_file(tmp_path, monkeypatch):
+    cache = AssetCache(str(tmp_path))
+
+    def save(f, buffer):
+        f.write(b"half")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(pyrffect_cache.np, "save", save)
+    with pytest.raises(OSError):
+        cache.store(str(tmp_path / "entry.npy"), np.zeros((2, 2, 4)))
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_store_still_decodes(tmp_path, monkeypatch):
+    source = tmp_path / "image.png"
+    source.write_bytes(b"image")
+    cache = AssetCache(str(tmp_path / "cache"))
+
+    def replace(source, destination):
+        raise OSError("Read-only file system")
+
+    monkeypatch.setattr(pyrffect_cache.os, "replace", replace)
+    buffer = cache.load(str(source), (), lambda: np.ones((2, 2, 4)))
+    assert np.array_equal(buffer, np.ones((2, 2, 4)))
+    assert os.listdir(tmp_path / "cache") == []
@@ -0,0 +1,48 @@
+import threading
+from multiprocessing.connection import Client
+
+import pytest
+
+from pyrffect_parser import load_pyrffect
+from output_image import frame_checksums
+import pyrffect_cluster
+from pyrffect_cluster import coordinate
+
+AUTHKEY = b"test"
+
+
+def test_coordinator_without_worker_stops(scenes, tmp_path):
+    out = str(tmp_path / "res.mp4")
+    with pytest.raises(Exception, match="No worker"):
+        coordinate(
+            "bimbamboum.xml", 1, out, 30, 4, ("localhost", 0), AUTHKEY, timeout=1
+        )
+
+
+def test_chunk_of_a_lost_worker_is_rendered_again(scenes, tmp_path, monkeypatch):
+    out = str(tmp_path / "res.mp4")
+    addresses = []
+    listen = pyrffect_cluster.Listener
+
+    def listener(address, authkey):
+        # the address of the listener, for the worker lost during its chunk
+        result = listen(address, authkey=authkey)
+        addresses.append(result.address)
+        return result
+
+    def lose_a_chunk():
+        while len(addresses) == 0:
+            threading.Event().wait(0.1)
+        with Client(addresses[0], authkey=AUTHKEY) as conn:
+            conn.recv()
+
+    monkeypatch.setattr(pyrffect_cluster, "Listener", listener)
+    threading.Thread(target=lose_a_chunk, daemon=True).start()
+    coordinate(
+        "bimbamboum.xml", 1, out, 30, 6, ("localhost", 0), AUTHKEY, 3, workers=1
+    )
+    assert len(frame_checksums(out)) == 6
+
+    p = load_pyrffect("bimbamboum.xml")
+    p.recover_seed(out)
+    assert p.seed == 1
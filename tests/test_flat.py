@@ -0,0 +1,35 @@
+import numpy as np
+
+from pyrffect_parser import load_pyrffect
+from output_image import OutputImage
+
+SCENE = """<?xml version="1.0" encoding="UTF-8"?>
+<Pyrffect out="flat.mp4" framerate="30" duration="1" width="120" height="80">
+    <flat color="50,80,120">
+        <light coords="10,10" color="127,0,200" dist_step="40" intensity="0.6"/>
+        <pixel square_size="4" ticks="1" displace_probability="0.75"/>
+    </flat>
+</Pyrffect>
+"""
+
+
+def frames(filename, start, end):
+    p = load_pyrffect(filename)
+    p.set_seed(5)
+    output = OutputImage(p.width, p.height, 30, None, p.fusion_mode)
+    p.seek(start)
+    result = []
+    for _ in range(start, end):
+        p.render(output)
+        result.append(np.array(output.frame()))
+        output.reset()
+    return result
+
+
+def test_seek_of_a_flat_with_effects_matches_sequential_render(tmp_path):
+    scene = tmp_path / "flat.xml"
+    scene.write_text(SCENE)
+    sequential = frames(str(scene), 0, 12)
+    sought = frames(str(scene), 8, 12)
+    for a, b in zip(sequential[8:], sought):
+        assert np.array_equal(a, b)
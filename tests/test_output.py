@@ -0,0 +1,37 @@
+import pytest
+
+from pyrffect_parser import load_pyrffect
+from output_image import OutputImage
+
+
+def test_writer_error_does_not_replace_an_interruption(scenes, tmp_path, monkeypatch):
+    p = load_pyrffect("bimbamboum.xml")
+    p.set_seed(1)
+    render = p.render
+    rendered = []
+
+    def write_pipe(self, frame, index=None):
+        raise IOError("ffmpeg stopped")
+
+    def interrupted(output):
+        if len(rendered) == 1:
+            raise KeyboardInterrupt
+        rendered.append(render(output))
+
+    monkeypatch.setattr(OutputImage, "write_pipe", write_pipe)
+    monkeypatch.setattr(p, "render", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        p.compute(str(tmp_path / "res.mp4"), 30, 5)
+    assert p.last_valid == 0
+
+
+def test_writer_error_is_raised_by_close(scenes, tmp_path, monkeypatch):
+    p = load_pyrffect("bimbamboum.xml")
+    p.set_seed(1)
+
+    def write_pipe(self, frame, index=None):
+        raise IOError("ffmpeg stopped")
+
+    monkeypatch.setattr(OutputImage, "write_pipe", write_pipe)
+    with pytest.raises(IOError, match="ffmpeg stopped"):
+        p.compute(str(tmp_path / "res.mp4"), 30, 1)
@@ -0,0 +1,31 @@
+import numpy as np
+
+from pixelmove import PixelMove
+
+
+def expected_remap(transform, shape):
+    remap = np.arange(shape[0] * shape[1])
+    for x, y, fx, fy, nx, ny, nfx, nfy in transform:
+        for i in range(min(fx - x, nfx - nx)):
+            for j in range(min(fy - y, nfy - ny)):
+                remap[(nx + i) * shape[1] + ny + j] = (x + i) * shape[1] + y + j
+    return remap
+
+
+def test_remap_keeps_the_last_of_overlapping_squares():
+    shape = (12, 12, 4)
+    # the squares moved to (2, 2), (3, 3) and (4, 2) overlap each other
+    transform = np.array(
+        [
+            [0, 0, 4, 4, 2, 2, 6, 6],
+            [8, 8, 12, 12, 3, 3, 7, 7],
+            [0, 8, 4, 12, 4, 2, 8, 6],
+            [8, 0, 12, 3, 2, 2, 6, 5],
+        ]
+    )
+    expected = expected_remap(transform, shape)
+    for batch_pixels in (PixelMove.BATCH_PIXELS, 16):
+        p = PixelMove(square_size=4)
+        p.BATCH_PIXELS = batch_pixels
+        p.last_transform = transform
+        assert np.array_equal(p.remap_table(shape), expected)
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from pyrffect_parser import load_pyrffect
+import output_image
+from output_image import frame_checksums
+
+
+@pytest.fixture(autouse=True)
+def log_file(monkeypatch, tmp_path):
+    # the log of ffmpeg stays out of the scenes
+    monkeypatch.setattr(output_image, "LOG_FILE", str(tmp_path / "log_file"))
+
+
+def test_resume_takes_the_seed_of_the_interrupted_render(scenes, tmp_path):
+    out = str(tmp_path / "res.mp4")
+    p = load_pyrffect("bimbamboum.xml")
+    p.compute(out, 30, 5)
+    seed = p.seed
+
+    p = load_pyrffect("bimbamboum.xml")
+    p.resume(out, 30, 10)
+    assert p.seed == seed
+    assert len(frame_checksums(out)) == 10
+    assert not any(".part" in name for name in os.listdir(tmp_path))
+
+
+def test_resume_without_the_seed_is_refused(scenes, tmp_path):
+    out = str(tmp_path / "res.mp4")
+    p = load_pyrffect("bimbamboum.xml")
+    p.compute(out, 30, 5)
+    os.remove(out + ".seed")
+
+    p = load_pyrffect("bimbamboum.xml")
+    with pytest.raises(Exception, match="seed"):
+        p.resume(out, 30, 10)
+    p.set_seed(1)
+    with open(out + ".seed", "w") as f:
+        f.write("2\n")
+    with pytest.raises(Exception, match="seed"):
+        p.recover_seed(out)
+
+
+def test_snapshots_of_another_render_are_dropped(scenes, tmp_path):
+    snapshots = str(tmp_path / "res.mp4.snapshots")
+    p = load_pyrffect("bimbamboum.xml", 0.5)
+    p.set_seed(1)
+    p.set_snapshots(2, snapshots, "bimbamboum.xml")
+    p.seek(6)
+
+    p = load_pyrffect("bimbamboum.xml", 0.5)
+    p.set_seed(1)
+    p.set_snapshots(2, snapshots, "bimbamboum.xml")
+    assert sorted(p.snapshots) == [0, 2, 4]
+    # another scale or scene file gives other states for the same seed
+    p = load_pyrffect("bimbamboum.xml")
+    p.set_seed(1)
+    p.set_snapshots(2, snapshots, "bimbamboum.xml")
+    assert p.snapshots == {}
+    p = load_pyrffect("final_hope.xml", 0.5)
+    p.set_seed(1)
+    p.set_snapshots(2, snapshots, "final_hope.xml")
+    assert p.snapshots == {}
@@ -0,0 +1,36 @@
+import json
+
+from pyrffect_parser import load_pyrffect
+import output_image
+from output_image import OutputImage
+from pyrffect_trace import Tracer
+
+
+def test_trace_of_a_pixelmove_scene_is_valid_json(scenes, tmp_path):
+    p = load_pyrffect("final_hope.xml")
+    p.set_seed(3)
+    tracer = Tracer()
+    p.set_tracer(tracer)
+    output = OutputImage(p.width, p.height, 30, None, p.fusion_mode)
+    p.seek(0)
+    for _ in range(90):
+        p.render(output)
+        output.frame()
+        output.reset()
+    trace = tmp_path / "trace.json"
+    tracer.write(str(trace))
+    with open(trace) as f:
+        events = json.load(f)["traceEvents"]
+    assert any(e["name"] == "PixelMove" for e in events)
+    assert any(e["cat"] == "paste_on" for e in events)
+
+
+def test_pipe_writes_are_tagged_with_their_frame(scenes, tmp_path, monkeypatch):
+    monkeypatch.setattr(output_image, "LOG_FILE", str(tmp_path / "log_file"))
+    p = load_pyrffect("bimbamboum.xml")
+    p.set_seed(1)
+    tracer = Tracer()
+    p.set_tracer(tracer)
+    p.compute(str(tmp_path / "res.mp4"), 30, 12)
+    writes = [e for e in tracer.events if e["name"] == "pipe write"]
+    assert [e["args"]["frame"] for e in writes] == list(range(12))